@@ -0,0 +1,92 @@
+import argparse
+import time
+import logging_service as logs
+import nlp
+
+
+def load_corpus(limit=None, include_replies=False):
+    """
+    Load the stored conversation messages to benchmark on.
+    :param limit: The maximum number of messages, or None for all of them.
+    :param include_replies: Whether our own replies are included, besides the received emails.
+    :return: The message bodies.
+    """
+    corpus = []
+    for _, sender, message in logs.get_all_messages():
+        if not message or (sender == "me" and not include_replies):
+            continue
+        corpus.append(message)
+        if limit is not None and len(corpus) >= limit:
+            break
+    return corpus
+
+def time_single(detector, corpus):
+    """
+    Classify the corpus one email at a time.
+    :return: The decisions and the latency of each email in milliseconds.
+    """
+    decisions, latencies = [], []
+    for body in corpus:
+        start = time.perf_counter()
+        decisions.append(detector.analyze_email(body))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return decisions, latencies
+
+def time_batch(detector, corpus, batch_size):
+    """
+    Classify the corpus in one analyze_many pass.
+    :return: The decisions and the total time in milliseconds.
+    """
+    start = time.perf_counter()
+    decisions = detector.analyze_many(corpus, batch_size=batch_size)
+    return decisions, (time.perf_counter() - start) * 1000
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def report(name, latencies, batch_ms, count):
+    print(f"{name:<10} mean {sum(latencies) / count:8.3f} ms  p50 {percentile(latencies, 0.5):8.3f} ms  "
+          f"p99 {percentile(latencies, 0.99):8.3f} ms  batch {batch_ms / count:8.3f} ms/email")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare PDF trigger detection with and without the lexical fast path on stored messages."
+    )
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of messages to use.")
+    parser.add_argument("--include-replies", action="store_true", help="Also use the replies we sent.")
+    parser.add_argument("--batch-size", type=int, default=32, help="Batch size of the analyze_many pass.")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.limit, args.include_replies)
+    if not corpus:
+        print("No stored messages to benchmark on.")
+        return
+    print(f"Benchmarking on {len(corpus)} messages.")
+
+    # The reference is the spaCy-only detector; the fast path is measured without audits
+    reference = nlp.PDFTriggerDetector(fast_path=False)
+    fast = nlp.PDFTriggerDetector(audit_rate=0)
+
+    reference_decisions, reference_latencies = time_single(reference, corpus)
+    fast_decisions, fast_latencies = time_single(fast, corpus)
+    _, reference_batch_ms = time_batch(reference, corpus, args.batch_size)
+    _, fast_batch_ms = time_batch(fast, corpus, args.batch_size)
+
+    report("spaCy", reference_latencies, reference_batch_ms, len(corpus))
+    report("fast path", fast_latencies, fast_batch_ms, len(corpus))
+
+    stats = fast.stats()
+    decided = stats["fast"] + stats["model"]
+    print(f"Decided without spaCy: {stats['fast'] / decided:.1%}")
+
+    agreed = sum(a == b for a, b in zip(reference_decisions, fast_decisions))
+    missed = sum(a and not b for a, b in zip(reference_decisions, fast_decisions))
+    extra = sum(b and not a for a, b in zip(reference_decisions, fast_decisions))
+    print(f"Agreement with spaCy: {agreed / len(corpus):.1%} "
+          f"({missed} triggers missed, {extra} extra triggers)")
+    print(f"Triggers: spaCy {sum(reference_decisions)}, fast path {sum(fast_decisions)}")
+
+
+if __name__ == "__main__":
+    main()
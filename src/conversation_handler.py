@@ -1,23 +1,44 @@
-from gmail_service import GmailService
-from openai_service import OpenAIClient
 import logging_service as logs
 from datetime import datetime, timezone, timedelta
 import os
-from bisect import insort
+import heapq
+import itertools
 from email.utils import parseaddr
-import nlp
 import honeytoken_service as honeytoken
 import threading
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from service_container import services
 
 
-gmail = GmailService()
-client = OpenAIClient()
-NLP = nlp.PDFTriggerDetector()
+# Number of emails analyzed together when several are classified at once
+NLP_BATCH_SIZE = int(os.getenv('NLP_BATCH_SIZE', '32'))
 
-queue = logs.load_queue_from_file()
+# Minutes to wait before retrying a reply that could not be sent
+RETRY_DELAY_MINUTES = int(os.getenv('RESPONSE_RETRY_MINUTES', '15'))
+
+# Number of attempts after which a reply is given up on
+MAX_SEND_ATTEMPTS = int(os.getenv('RESPONSE_MAX_ATTEMPTS', '5'))
+
+# Pending replies as a heap of (response_time, sequence, entry)
+queue = []
+queue_sequence = itertools.count()
+
+# Replies handed to the sender that have not been sent yet, by email ID.
+# They stay persisted until dequeue_email acknowledges them.
+in_flight = {}
 
 queue_lock = threading.Lock()
+queue_condition = threading.Condition(queue_lock)
+
+# Background workers preparing reply drafts ahead of the response time
+draft_executor = ThreadPoolExecutor(max_workers=int(os.getenv('DRAFT_WORKERS', '2')), thread_name_prefix="draft-worker")
+
+for loaded_entry in logs.load_queue_from_file():
+    heapq.heappush(queue, (loaded_entry["response_time"], next(queue_sequence), loaded_entry))
+# Start from a fresh snapshot and an empty journal
+logs.compact_queue([entry for _, _, entry in queue])
 
 def send_first_reply(sender, subject):
     """
@@ -25,13 +46,13 @@ def send_first_reply(sender, subject):
     :param sender: The sender's email address.
     :param subject: The subject of the email.
     """
-    email_id = gmail.find_message_by_sender_and_subject(sender,subject)
+    email_id = services.gmail().find_message_by_sender_and_subject(sender,subject)
 
     if email_id is None:
         print("Email not found.")
         return
 
-    email = gmail.get_email_from_id(email_id)
+    email = services.gmail().get_email_from_id(email_id)
     body = email.get('full_body')
 
     converted_date = datetime.fromtimestamp(int(email.get('internalDate')) / 1000, tz=timezone.utc)
@@ -51,9 +72,11 @@ def send_first_reply(sender, subject):
         print("Failed to get a response.")
         return
     
-    res = gmail.reply_to_email(email, response, token)
+    res = services.gmail().reply_to_email(email, response, token)
     if res is not None and res['id'] and res['labelIds']:
         logs.add_to_log(conv_id, "me", response, datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z'))
+        if services.gmail().mark_as_read('me', email_id) == -1:
+            print("Failed to mark the email as read.")
     else:
         print("Failed to send the reply.")
 
@@ -80,7 +103,7 @@ def start_conversation(sender, subject, body):
         print("Failed to get a response.")
         return
     
-    res = gmail.send_email(sender, subject, response, token)
+    res = services.gmail().send_email(sender, subject, response, token)
     if res is not None and res['id'] and res['labelIds']:
         logs.add_to_log(conv_id, "me", response, datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z'))
     else:
@@ -92,7 +115,7 @@ def get_new_emails():
     Get new emails from the inbox.
     :return: The new emails.
     """
-    return gmail.check_for_new_emails(include_spam=True)
+    return services.gmail().check_for_new_emails(include_spam=True)
 
 def has_new_emails():
     """
@@ -105,9 +128,10 @@ def has_new_emails():
 def get_queue():
     """
     Get the current response queue.
-    :return: The response queue.
+    :return: The pending entries, sorted by response time.
     """
-    return queue
+    with queue_lock:
+        return [entry for _, _, entry in sorted(queue, key=lambda item: item[:2])]
 
 def generate_reply(body):
     """
@@ -115,86 +139,275 @@ def generate_reply(body):
     :param email: The email to reply to.
     :return: The reply message.
     """
-    response = client.answer_email(body)
+    response = services.openai().answer_email(body)
     return response
 
 def generate_reply_with_pdf(body):
     """
-    Generate a reply to the sender with a PDF attachment.
+    Generate a reply to the sender with a PDF attachment, together with the PDF's name and content.
     :param email: The email to reply to.
-    :return: The reply message.
+    :return: A dictionary with "reply", "pdf_name" and "pdf_content", or None on failure.
     """
-    response = client.answer_email_with_pdf(body)
+    response = services.openai().generate_pdf_reply(body)
     return response
 
 def handle_incoming_message(email):
     """
     Handle an incoming message from the sender.
     """
+    handle_incoming_messages([email])
+
+def handle_incoming_messages(emails):
+    """
+    Handle the incoming messages of a poll, marking them all as read with one request,
+    or one by one if that request fails.
+    :param emails: The new emails of ongoing conversations.
+    :return: The IDs of the emails that were handled; the others are left for the next poll.
+    """
+    if not emails:
+        return []
+    res = services.gmail().mark_as_read_batch('me', [email['id'] for email in emails])
+    if res == -1:
+        print("Failed to mark the emails as read together, marking them one by one.")
+
+    handled = []
+    for email in emails:
+        if res == -1 and services.gmail().mark_as_read('me', email['id']) == -1:
+            print(f"Failed to mark email {email['id']} as read.")
+            continue
+        try:
+            record_incoming_message(email)
+        except Exception as error:
+            print(f"An error occurred while recording email {email['id']}: {error}")
+            continue
+        handled.append(email['id'])
+    return handled
+
+def record_incoming_message(email):
+    """
+    Log an incoming message that was marked as read and queue the reply to it.
+    """
     conv_id = logs.get_conversation_id(email['sender'])
 
     converted_date = datetime.fromtimestamp(int(email['timestamp']) / 1000, tz=timezone.utc)
     date = converted_date.strftime('%Y-%m-%d %H:%M:%S %Z')
 
-    res = gmail.mark_as_read('me', email['id'])
-    if res == -1:
-        print("Failed to mark the email as read.")
-        return
-
     logs.add_to_log(conv_id, email['sender'], email['body'], date)
 
-    add_email_to_queue(email['id'])
+    # Earlier replies still waiting in this conversation now have to take the new message into account
+    for entry in get_queue():
+        if entry.get("conversation_id") == conv_id:
+            schedule_draft(entry["email_id"])
 
+    add_email_to_queue(email['id'], conv_id, email['body'], services.gmail().get_reply_headers(email))
 
-def send_response(email_id):
+
+def deadline_passed(deadline, email_id):
     """
-    Handle an incoming message from the sender.
+    Check if a reply ran out of time.
+    :param deadline: The time.monotonic() deadline of the reply, or None for no deadline.
+    :param email_id: The ID of the email being replied to.
+    :return: True if the deadline has passed, False otherwise.
     """
-    email = gmail.get_message_details('me',email_id)
-    raw_sender = next((header['value'] for header in email['payload']['headers'] if header['name'] == 'From'), None)
-    sender_email = parseaddr(raw_sender)[1]  # Extract only the email address    
-    conv_id = logs.get_conversation_id(sender_email)
-
-    body = gmail.get_latest_message_content(email)
+    if deadline is not None and time.monotonic() > deadline:
+        print(f"Reply to {email_id} timed out before it was sent.")
+        return True
+    return False
 
+def prepare_draft(conv_id, body, pdf_trigger=None):
+    """
+    Prepare the reply to a message: the reply text, whether a PDF is attached and the PDF itself.
+    :param conv_id: The ID of the conversation.
+    :param body: The latest message content.
+    :param pdf_trigger: Whether the message asks for a document, if it was already analyzed.
+    :return: The draft, or None if no reply could be generated.
+    """
     conv_length = logs.get_conversation_length(conv_id)
 
-    if not logs.has_signature_id(conv_id):
-        logs.add_signature_id(conv_id)
-
-    sig_id = logs.get_signature_id(conv_id)
-
     if conv_length < 2 and not logs.has_honeytoken_id(conv_id):
         include_pdf = False
     else:
-        include_pdf = NLP.analyze_email(body) and not logs.has_honeytoken_id(conv_id)
+        if pdf_trigger is None:
+            pdf_trigger = services.nlp().analyze_email(body)
+        include_pdf = pdf_trigger and not logs.has_honeytoken_id(conv_id)
+
+    draft = {"conversation_length": conv_length, "include_pdf": include_pdf}
 
     if not include_pdf:
-        response = generate_reply(body)
+        draft["response"] = generate_reply(body)
+    else:
+        # A ready decoy only needs the reply text, otherwise the PDF content is generated with it
+        decoy = honeytoken.take_decoy(body)
+        if decoy is not None:
+            draft["response"] = services.openai().answer_email_with_pdf(body)
+            draft["honeytoken_id"], draft["pdf_filename"], draft["pdf_data"] = decoy
+        else:
+            pdf_reply = generate_reply_with_pdf(body)
+            draft["response"] = pdf_reply["reply"] if pdf_reply is not None else None
+            if pdf_reply is not None:
+                draft["honeytoken_id"], draft["pdf_filename"], draft["pdf_data"] = honeytoken.generate_pdf(
+                    body, name=pdf_reply["pdf_name"], content=pdf_reply["pdf_content"], conversation_id=conv_id,
+                    use_pool=False
+                )
+
+    if draft["response"] is None:
+        print("Failed to get a response.")
+        return None
+    return draft
+
+def store_draft_pdf(draft):
+    """
+    Move the PDF of a draft from memory to ../pdf_files so the draft can be persisted.
+    :param draft: The draft returned by prepare_draft.
+    """
+    if "pdf_data" not in draft:
+        return
+    os.makedirs("../pdf_files", exist_ok=True)
+    draft["pdf_path"] = f"../pdf_files/{draft['honeytoken_id']}.pdf"
+    with open(draft["pdf_path"], "wb") as file:
+        file.write(draft.pop("pdf_data"))
+
+def discard_draft_pdf(draft):
+    """
+    Delete the PDF file of a draft that was sent or will not be sent.
+    :param draft: The draft, or None.
+    """
+    if draft is None or "pdf_path" not in draft:
+        return
+    try:
+        os.remove(draft["pdf_path"])
+    except FileNotFoundError:
+        pass
+    except OSError as error:
+        print(f"An error occurred while deleting {draft['pdf_path']}: {error}")
+
+def draft_is_current(draft, conv_id):
+    """
+    Check if a draft was prepared against the current state of its conversation.
+    :param draft: The draft returned by prepare_draft.
+    :param conv_id: The ID of the conversation.
+    :return: True if no message was added to the conversation since the draft was prepared.
+    """
+    return draft["conversation_length"] == logs.get_conversation_length(conv_id)
 
-        if response is None:
-            print("Failed to get a response.")
+def find_queued_entry(email_id):
+    """Find a pending queue entry by email ID. Must be called with queue_lock held."""
+    return next((entry for _, _, entry in queue if entry["email_id"] == email_id), None)
+
+def schedule_draft(email_id, pdf_trigger=None):
+    """
+    Prepare the draft of a queued reply in the background.
+    :param email_id: The ID of the queued email.
+    :param pdf_trigger: Whether the email asks for a document, if it was already analyzed.
+    """
+    draft_executor.submit(draft_queued_email, email_id, pdf_trigger)
+
+def draft_queued_email(email_id, pdf_trigger=None):
+    """
+    Prepare and persist the draft of a queued reply, so that sending it only transmits.
+    :param email_id: The ID of the queued email.
+    :param pdf_trigger: Whether the email asks for a document, if it was already analyzed.
+    """
+    with queue_lock:
+        entry = find_queued_entry(email_id)
+        if entry is None or entry.get("body") is None or entry.get("conversation_id") is None:
             return
-    
-        res = gmail.reply_to_email(email, response, sig_id)
-    else:
-        response = generate_reply_with_pdf(body)
+        conv_id, body = entry["conversation_id"], entry["body"]
+
+    try:
+        draft = prepare_draft(conv_id, body, pdf_trigger)
+    except Exception as error:
+        print(f"An error occurred while drafting the reply to {email_id}: {error}")
+        return
+    if draft is None:
+        return
+    store_draft_pdf(draft)
 
-        if response is None:
-            print("Failed to get a response.")
+    with queue_lock:
+        entry = find_queued_entry(email_id)
+        # The reply may have become due or been replaced while the draft was prepared
+        if entry is None:
+            discard_draft_pdf(draft)
             return
-    
-        token, path = honeytoken.generate_pdf(body)
+        discard_draft_pdf(entry.get("draft"))
+        entry["draft"] = draft
+        save_queue({"op": "enqueue", "entry": entry})
+    print(f"Draft prepared for email {email_id}.")
+
+def send_response(entry, deadline=None):
+    """
+    Send the reply to a queued email, built from the reply headers and body stored with it.
+    :param entry: The queue entry of the email. Its draft, if any, is regenerated if
+                  the conversation changed since it was prepared.
+    :param deadline: Optional time.monotonic() deadline after which the reply is not sent.
+    :return: True if the reply was sent, False otherwise.
+    """
+    email_id = entry["email_id"]
+    draft = entry.get("draft")
+    reply_headers = entry.get("reply_headers")
+    body = entry.get("body")
+
+    if reply_headers is None or body is None:
+        # Queued before the reply headers were stored with the entry
+        message = services.gmail().get_message_details('me', email_id)
+        if message is None:
+            return False
+        reply_headers = services.gmail().get_reply_headers(message)
+        body = services.gmail().get_latest_message_content(message)
+
+    email = dict(reply_headers, id=email_id)
+    sender_email = parseaddr(reply_headers['from'])[1]  # Extract only the email address
+    conv_id = logs.get_conversation_id(sender_email)
 
-        logs.add_honeytoken_id(token, conv_id)
+    if not logs.has_signature_id(conv_id):
+        logs.add_signature_id(conv_id)
 
-        res = gmail.reply_to_email_with_attachment(email, response, path, sig_id)
+    sig_id = logs.get_signature_id(conv_id)
+
+    if entry.get("attempts"):
+        # A failed attempt may still have been delivered
+        try:
+            sent = services.gmail().find_sent_reply(reply_headers['threadId'], reply_headers['message_id'])
+        except Exception as error:
+            print(f"An error occurred while checking for an earlier reply to {email_id}: {error}")
+            return False
+        if sent is not None:
+            print(f"Reply to email {email_id} was already sent by an earlier attempt.")
+            response = draft["response"] if draft is not None else sent.get('snippet', '')
+            logs.add_to_log(conv_id, "me", response, datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z'))
+            dequeue_email(email_id)
+            return True
+
+    if draft is not None and not draft_is_current(draft, conv_id):
+        print(f"Draft for email {email_id} is out of date, regenerating it.")
+        discard_draft_pdf(entry.pop("draft"))
+        draft = None
+
+    if draft is None:
+        draft = prepare_draft(conv_id, body)
+        if draft is None:
+            return False
+
+    if deadline_passed(deadline, email_id):
+        return False
+
+    response = draft["response"]
+    if not draft["include_pdf"]:
+        res = services.gmail().reply_to_email(email, response, sig_id)
+    else:
+        logs.add_honeytoken_id(draft["honeytoken_id"], conv_id)
+
+        # Drafts made at send time keep the PDF in memory, persisted drafts have it on disk
+        attachment = draft["pdf_data"] if "pdf_data" in draft else draft["pdf_path"]
+        res = services.gmail().reply_to_email_with_attachment(email, response, attachment, sig_id, draft["pdf_filename"])
 
     if res is not None and res['id'] and res['labelIds']:
         logs.add_to_log(conv_id, "me", response, datetime.now().strftime('%Y-%m-%d %H:%M:%S %Z'))
-        dequeue_email()
+        dequeue_email(email_id)
+        return True
     else:
         print("Failed to send the reply.")
+        return False
 
 def has_conversation(sender):
     """
@@ -202,7 +415,7 @@ def has_conversation(sender):
     :return: True if a conversation is in progress, False otherwise.
     """
     conv_id = logs.get_conversation_id(sender)
-    return os.path.exists(f"../logs/{conv_id}.json")
+    return logs.has_conversation_log(conv_id)
 
 def generate_response_time():
     """
@@ -235,36 +448,117 @@ def generate_response_time():
 
     return response_time
 
-def add_email_to_queue(email_id):
-    global queue
-    with queue_lock:  # Ensure exclusive access
-        queue = logs.load_queue_from_file()  # Reload the queue from the file
+def save_queue(record):
+    """
+    Journal a change to the queue, compacting the journal into a snapshot of the
+    pending and in-flight entries when it grows. Must be called with queue_lock held.
+    :param record: The journal record describing the change.
+    """
+    if logs.append_to_queue_journal(record) >= logs.QUEUE_COMPACT_EVERY:
+        entries = [entry for _, _, entry in queue] + list(in_flight.values())
+        logs.compact_queue(sorted(entries, key=lambda x: x["response_time"]))
 
+def add_email_to_queue(email_id, conversation_id=None, body=None, reply_headers=None):
+    """
+    Schedule a reply to an email and wake the sender if it is due first.
+    The reply is drafted in the background when the message body is given.
+    :param email_id: The ID of the email to reply to.
+    :param conversation_id: The ID of the conversation the email belongs to.
+    :param body: The latest message content of the email.
+    :param reply_headers: The threadId, Message-ID, From and Subject of the email, so that
+                          the reply is sent without fetching it again.
+    """
+    with queue_condition:  # Ensure exclusive access
         # Generate a response time for this email
         response_time = generate_response_time()
         
         # Create a dictionary with email details
-        email_entry = {"email_id": email_id, "response_time": response_time}
+        email_entry = {"email_id": email_id, "response_time": response_time,
+                       "conversation_id": conversation_id, "body": body, "reply_headers": reply_headers}
         
-        # Insert email into the queue in a sorted position based on response time
-        insort(queue, email_entry, key=lambda x: x["response_time"])
-
-        print("Queue:" + str(queue))
-        logs.save_queue_to_file(queue)  # Save the updated queue to the file
+        heapq.heappush(queue, (response_time, next(queue_sequence), email_entry))
+        save_queue({"op": "enqueue", "entry": email_entry})
+        queue_condition.notify_all()
 
         print(f"Email {email_id} added to the queue for {response_time}")
 
-def dequeue_email():
-    global queue
-    with queue_lock:  # Ensure exclusive access
-        queue = logs.load_queue_from_file()  # Reload the queue from the file
-
-        print("Dequeueing email " + str(queue))
-        if len(queue) > 0:
-            ret = queue.pop(0)
-            print("Queue:" + str(queue))
-            logs.save_queue_to_file(queue)  # Save the updated queue to the file
-            print(f"Email {ret['email_id']} dequeued.")
-            return ret
-        return None
-    
\ No newline at end of file
+    schedule_draft(email_id)
+
+def wait_for_due_emails():
+    """
+    Block until at least one reply is due, sleeping exactly until the next deadline.
+    :return: All entries whose response time has passed, in response time order.
+    """
+    with queue_condition:
+        while True:
+            if not queue:
+                queue_condition.wait()
+                continue
+            delay = (queue[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                queue_condition.wait(timeout=delay)
+                continue
+
+            due = []
+            now = datetime.now()
+            while queue and queue[0][0] <= now:
+                _, _, entry = heapq.heappop(queue)
+                in_flight[entry["email_id"]] = entry
+                due.append(entry)
+            return due
+
+def retry_email(entry):
+    """
+    Put back a reply that could not be sent, unless it ran out of attempts.
+    :param entry: The queue entry returned by wait_for_due_emails.
+    """
+    with queue_condition:
+        in_flight.pop(entry["email_id"], None)
+        attempts = entry.get("attempts", 0) + 1
+        if attempts >= MAX_SEND_ATTEMPTS:
+            print(f"Giving up on email {entry['email_id']} after {attempts} attempts.")
+            save_queue({"op": "ack", "email_id": entry["email_id"]})
+            discard_draft_pdf(entry.get("draft"))
+        else:
+            retry_entry = {**entry, "attempts": attempts,
+                           "response_time": datetime.now() + timedelta(minutes=RETRY_DELAY_MINUTES)}
+            heapq.heappush(queue, (retry_entry["response_time"], next(queue_sequence), retry_entry))
+            save_queue({"op": "enqueue", "entry": retry_entry})
+            print(f"Email {entry['email_id']} will be retried at {retry_entry['response_time']}")
+            queue_condition.notify_all()
+
+def dequeue_email(email_id):
+    """
+    Remove a sent reply from the queue.
+    :param email_id: The ID of the email that was replied to.
+    :return: The removed entry, or None if it was not queued.
+    """
+    with queue_condition:  # Ensure exclusive access
+        ret = in_flight.pop(email_id, None)
+        for index, (_, _, entry) in enumerate(queue):
+            if entry["email_id"] == email_id:
+                ret = entry
+                queue.pop(index)
+                heapq.heapify(queue)
+                break
+        if ret is None:
+            return None
+        save_queue({"op": "ack", "email_id": email_id})
+        discard_draft_pdf(ret.get("draft"))
+        print(f"Email {email_id} dequeued.")
+        return ret
+
+def resume_drafts():
+    """
+    Draft the replies that were queued without one before a restart,
+    analyzing their emails for document requests in one pass.
+    """
+    entries = [entry for entry in get_queue() if "draft" not in entry and entry.get("body") is not None]
+    if not entries:
+        return
+    triggers = services.nlp().analyze_many([entry["body"] for entry in entries], batch_size=NLP_BATCH_SIZE)
+    for entry, trigger in zip(entries, triggers):
+        schedule_draft(entry["email_id"], trigger)
+
+# Resumed on a draft worker, so that importing this module does not wait for spaCy
+draft_executor.submit(resume_drafts)
@@ -0,0 +1,459 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from glob import glob
+
+# Directory holding the conversation logs and the SQLite database
+LOG_DIR = os.getenv('LOG_DIR', '../logs')
+
+# Storage backend used by logging_service ("sqlite" or "json")
+LOG_BACKEND = os.getenv('LOG_BACKEND', 'sqlite')
+
+# Path of the SQLite database used by the "sqlite" backend
+LOG_DB_PATH = os.getenv('LOG_DB_PATH', os.path.join(LOG_DIR, 'conversations.db'))
+
+
+class JSONConversationStore:
+    """
+    Conversation storage backed by one JSON file per conversation.
+    This is the original layout of ../logs and is kept for compatibility.
+    """
+
+    def __init__(self, log_dir=LOG_DIR):
+        """
+        Initialize the store.
+        :param log_dir: The directory holding the conversation files.
+        """
+        self.log_dir = log_dir
+        self.lock = threading.RLock()
+        os.makedirs(self.log_dir, exist_ok=True)
+
+        # Reverse index of token -> (conversation_id, kind)
+        self.token_index_path = os.path.join(self.log_dir, "token_index.jsonl")
+        self.token_index = {}
+        self.token_index_size = 0
+        self._load_token_index()
+
+    def _path(self, conversation_id):
+        return os.path.join(self.log_dir, f"{conversation_id}.json")
+
+    def _read(self, conversation_id):
+        with open(self._path(conversation_id), "r") as file:
+            return json.load(file)
+
+    def _write(self, conversation_id, conversation_log):
+        with open(self._path(conversation_id), "w") as file:
+            json.dump(conversation_log, file)
+
+    def create_conversation(self, conversation_id, sender):
+        """
+        Create a new conversation.
+        :return: True if the conversation was created, False if it already existed.
+        """
+        with self.lock:
+            if os.path.exists(self._path(conversation_id)):
+                return False
+            self._write(conversation_id, {"conversation_id": conversation_id, "sender": sender, "messages": []})
+            return True
+
+    def conversation_exists(self, conversation_id):
+        return os.path.exists(self._path(conversation_id))
+
+    def get_conversation(self, conversation_id):
+        if not self.conversation_exists(conversation_id):
+            return None
+        return self._read(conversation_id)
+
+    def append_message(self, conversation_id, sender, message, timestamp):
+        with self.lock:
+            conversation_log = self._read(conversation_id)
+            conversation_log["messages"].append({"from": sender, "message": message, "timestamp": timestamp})
+            self._write(conversation_id, conversation_log)
+
+    def count_messages(self, conversation_id):
+        return len(self._read(conversation_id)["messages"])
+
+    def iter_messages(self):
+        """Yield every stored message as a (conversation_id, sender, message) tuple."""
+        for name in sorted(os.listdir(self.log_dir)):
+            if name.endswith(".json"):
+                conversation_log = self._read(name[:-len(".json")])
+                for message in conversation_log["messages"]:
+                    yield conversation_log["conversation_id"], message["from"], message["message"]
+
+    def set_token(self, conversation_id, kind, token_id):
+        """
+        Store a token on a conversation.
+        :param kind: "signature" or "honeytoken".
+        """
+        with self.lock:
+            conversation_log = self._read(conversation_id)
+            conversation_log[f"{kind}_id"] = token_id
+            conversation_log.setdefault("interaction", [])
+            self._write(conversation_id, conversation_log)
+            self.index_token(token_id, conversation_id, kind)
+
+    def get_token(self, conversation_id, kind):
+        return self._read(conversation_id).get(f"{kind}_id")
+
+    def index_token(self, token_id, conversation_id, kind):
+        """
+        Record a token in the reverse index. The index is an append-only
+        JSON lines file so that recording a token never rewrites it.
+        """
+        with self.lock:
+            self._load_token_index()
+            if token_id in self.token_index:
+                return
+            with open(self.token_index_path, "a") as file:
+                file.write(json.dumps({"token_id": token_id, "conversation_id": conversation_id, "kind": kind}) + "\n")
+            self.token_index[token_id] = (conversation_id, kind)
+
+    def lookup_token(self, token_id):
+        """
+        Find the conversation a token belongs to through the reverse index.
+        :return: A (conversation_id, kind) tuple, or None if the token is unknown.
+        """
+        with self.lock:
+            match = self.token_index.get(token_id)
+            if match is None:
+                # Another process may have appended to the index since it was last read
+                self._load_token_index()
+                match = self.token_index.get(token_id)
+            return match
+
+    def rebuild_token_index(self):
+        """
+        Add every token found in the conversation files to the reverse index.
+        Tokens already in the index are kept, so replaced signature IDs still resolve.
+        :return: The number of tokens added.
+        """
+        added = 0
+        for path in glob(os.path.join(self.log_dir, "*.json")):
+            try:
+                with open(path, "r") as file:
+                    conversation_log = json.load(file)
+            except ValueError as error:
+                print(f"Skipping unreadable conversation log {path}: {error}")
+                continue
+            for kind in ("honeytoken", "signature"):
+                token_id = conversation_log.get(f"{kind}_id")
+                if token_id and self.lookup_token(token_id) is None:
+                    self.index_token(token_id, conversation_log["conversation_id"], kind)
+                    added += 1
+        return added
+
+    def _load_token_index(self):
+        """Read the reverse index file if it changed since the last read."""
+        if not os.path.exists(self.token_index_path):
+            return
+        size = os.path.getsize(self.token_index_path)
+        if size == self.token_index_size:
+            return
+        with open(self.token_index_path, "rb") as file:
+            file.seek(self.token_index_size)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                entry = json.loads(line)
+                self.token_index[entry["token_id"]] = (entry["conversation_id"], entry["kind"])
+                self.token_index_size += len(line)
+
+    def add_interaction(self, conversation_id, token_id, kind, ip_address, user_agent, timestamp):
+        with self.lock:
+            conversation_log = self._read(conversation_id)
+            conversation_log.setdefault("interaction", []).append(
+                {"ip_address": ip_address, "user_agent": user_agent, "timestamp": timestamp}
+            )
+            self._write(conversation_id, conversation_log)
+
+    def add_interactions(self, interactions):
+        """
+        Add several interactions, rewriting each conversation file once.
+        :param interactions: (conversation_id, token_id, kind, ip_address, user_agent, timestamp) tuples.
+        """
+        by_conversation = {}
+        for conversation_id, _, _, ip_address, user_agent, timestamp in interactions:
+            by_conversation.setdefault(conversation_id, []).append(
+                {"ip_address": ip_address, "user_agent": user_agent, "timestamp": timestamp}
+            )
+        with self.lock:
+            for conversation_id, entries in by_conversation.items():
+                conversation_log = self._read(conversation_id)
+                conversation_log.setdefault("interaction", []).extend(entries)
+                self._write(conversation_id, conversation_log)
+
+
+class SQLiteConversationStore:
+    """
+    Conversation storage backed by SQLite in WAL mode.
+    Messages and interactions are append-only rows, so adding to a conversation
+    never rewrites it, and tokens are resolved through the tokens table,
+    a reverse index of every token ever issued.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        conversation_id TEXT PRIMARY KEY,
+        sender TEXT NOT NULL,
+        signature_id TEXT,
+        honeytoken_id TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversations_signature_id ON conversations (signature_id);
+    CREATE INDEX IF NOT EXISTS idx_conversations_honeytoken_id ON conversations (honeytoken_id);
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id TEXT NOT NULL,
+        sender TEXT,
+        message TEXT,
+        timestamp TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages (conversation_id);
+    CREATE TABLE IF NOT EXISTS interactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        conversation_id TEXT NOT NULL,
+        token_id TEXT,
+        kind TEXT,
+        ip_address TEXT,
+        user_agent TEXT,
+        timestamp TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_interactions_conversation_id ON interactions (conversation_id);
+    CREATE TABLE IF NOT EXISTS tokens (
+        token_id TEXT PRIMARY KEY,
+        conversation_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        created_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS migrations (
+        name TEXT PRIMARY KEY,
+        applied_at TEXT
+    );
+    """
+
+    def __init__(self, db_path=LOG_DB_PATH):
+        """
+        Initialize the store and create the schema if needed.
+        :param db_path: The path of the SQLite database file.
+        """
+        self.db_path = db_path
+        self.local = threading.local()
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection().executescript(self.SCHEMA)
+
+    def _connection(self):
+        """Return the SQLite connection of the calling thread, opening it on first use."""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def create_conversation(self, conversation_id, sender):
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO conversations (conversation_id, sender) VALUES (?, ?)",
+                (conversation_id, sender)
+            )
+            return cursor.rowcount == 1
+
+    def conversation_exists(self, conversation_id):
+        row = self._connection().execute(
+            "SELECT 1 FROM conversations WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        return row is not None
+
+    def get_conversation(self, conversation_id):
+        """
+        Get a conversation in the same shape as the legacy JSON log.
+        :return: The conversation log, or None if it does not exist.
+        """
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT * FROM conversations WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        conversation_log = {"conversation_id": row["conversation_id"], "sender": row["sender"], "messages": []}
+        for message in connection.execute(
+            "SELECT sender, message, timestamp FROM messages WHERE conversation_id = ? ORDER BY id", (conversation_id,)
+        ):
+            conversation_log["messages"].append(
+                {"from": message["sender"], "message": message["message"], "timestamp": message["timestamp"]}
+            )
+        if row["signature_id"] is not None:
+            conversation_log["signature_id"] = row["signature_id"]
+        if row["honeytoken_id"] is not None:
+            conversation_log["honeytoken_id"] = row["honeytoken_id"]
+        conversation_log["interaction"] = [
+            {"ip_address": interaction["ip_address"], "user_agent": interaction["user_agent"], "timestamp": interaction["timestamp"]}
+            for interaction in connection.execute(
+                "SELECT ip_address, user_agent, timestamp FROM interactions WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,)
+            )
+        ]
+        return conversation_log
+
+    def append_message(self, conversation_id, sender, message, timestamp):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO messages (conversation_id, sender, message, timestamp) VALUES (?, ?, ?, ?)",
+                (conversation_id, sender, message, timestamp)
+            )
+
+    def count_messages(self, conversation_id):
+        return self._connection().execute(
+            "SELECT COUNT(*) FROM messages WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()[0]
+
+    def iter_messages(self):
+        """Yield every stored message as a (conversation_id, sender, message) tuple."""
+        for row in self._connection().execute("SELECT conversation_id, sender, message FROM messages ORDER BY id"):
+            yield row["conversation_id"], row["sender"], row["message"]
+
+    def set_token(self, conversation_id, kind, token_id):
+        with self._connection() as connection:
+            connection.execute(
+                f"UPDATE conversations SET {self._token_column(kind)} = ? WHERE conversation_id = ?",
+                (token_id, conversation_id)
+            )
+            connection.execute(
+                "INSERT OR IGNORE INTO tokens (token_id, conversation_id, kind, created_at) VALUES (?, ?, ?, ?)",
+                (token_id, conversation_id, kind, datetime.now().isoformat())
+            )
+
+    def get_token(self, conversation_id, kind):
+        row = self._connection().execute(
+            f"SELECT {self._token_column(kind)} FROM conversations WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def index_token(self, token_id, conversation_id, kind):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO tokens (token_id, conversation_id, kind, created_at) VALUES (?, ?, ?, ?)",
+                (token_id, conversation_id, kind, datetime.now().isoformat())
+            )
+
+    def lookup_token(self, token_id):
+        row = self._connection().execute(
+            "SELECT conversation_id, kind FROM tokens WHERE token_id = ?", (token_id,)
+        ).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def rebuild_token_index(self):
+        """
+        Add the current token of every conversation to the reverse index.
+        Tokens already in the index are kept, so replaced signature IDs still resolve.
+        :return: The number of tokens added.
+        """
+        added = 0
+        now = datetime.now().isoformat()
+        with self._connection() as connection:
+            for kind in ("honeytoken", "signature"):
+                column = self._token_column(kind)
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO tokens (token_id, conversation_id, kind, created_at) "
+                    f"SELECT {column}, conversation_id, ?, ? FROM conversations WHERE {column} IS NOT NULL",
+                    (kind, now)
+                )
+                added += cursor.rowcount
+        return added
+
+    def add_interaction(self, conversation_id, token_id, kind, ip_address, user_agent, timestamp):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO interactions (conversation_id, token_id, kind, ip_address, user_agent, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (conversation_id, token_id, kind, ip_address, user_agent, timestamp)
+            )
+
+    def add_interactions(self, interactions):
+        """
+        Add several interactions in one transaction.
+        :param interactions: (conversation_id, token_id, kind, ip_address, user_agent, timestamp) tuples.
+        """
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO interactions (conversation_id, token_id, kind, ip_address, user_agent, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                interactions
+            )
+
+    def migrate_from_json(self, log_dir=LOG_DIR):
+        """
+        Import the legacy ../logs/*.json files once. The files are left in place.
+        :param log_dir: The directory holding the JSON conversation logs.
+        :return: The number of conversations imported.
+        """
+        connection = self._connection()
+        if connection.execute("SELECT 1 FROM migrations WHERE name = 'json_logs'").fetchone() is not None:
+            return 0
+
+        imported = 0
+        with connection:
+            for path in sorted(glob(os.path.join(log_dir, "*.json"))):
+                try:
+                    with open(path, "r") as file:
+                        conversation_log = json.load(file)
+                    conversation_id = conversation_log["conversation_id"]
+                except (ValueError, KeyError) as error:
+                    print(f"Skipping unreadable conversation log {path}: {error}")
+                    continue
+
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO conversations (conversation_id, sender, signature_id, honeytoken_id) "
+                    "VALUES (?, ?, ?, ?)",
+                    (conversation_id, conversation_log.get("sender", ""),
+                     conversation_log.get("signature_id"), conversation_log.get("honeytoken_id"))
+                )
+                if cursor.rowcount != 1:
+                    continue
+
+                connection.executemany(
+                    "INSERT INTO messages (conversation_id, sender, message, timestamp) VALUES (?, ?, ?, ?)",
+                    [(conversation_id, m.get("from"), m.get("message"), m.get("timestamp"))
+                     for m in conversation_log.get("messages", [])]
+                )
+                interactions = conversation_log.get("interaction", []) + conversation_log.get("interactions", [])
+                connection.executemany(
+                    "INSERT INTO interactions (conversation_id, ip_address, user_agent, timestamp) VALUES (?, ?, ?, ?)",
+                    [(conversation_id, i.get("ip_address"), i.get("user_agent"), i.get("timestamp"))
+                     for i in interactions]
+                )
+                imported += 1
+
+            connection.execute(
+                "INSERT OR IGNORE INTO migrations (name, applied_at) VALUES ('json_logs', ?)", (datetime.now().isoformat(),)
+            )
+        print(f"Migrated {imported} conversation logs from {log_dir} to {self.db_path}")
+        return imported
+
+    @staticmethod
+    def _token_column(kind):
+        if kind not in ("signature", "honeytoken"):
+            raise ValueError(f"Unknown token kind: {kind}")
+        return f"{kind}_id"
+
+
+def open_store(backend=LOG_BACKEND):
+    """
+    Open the configured conversation store.
+    :param backend: "sqlite" (default) or "json".
+    :return: The conversation store.
+    """
+    if backend == "json":
+        return JSONConversationStore(LOG_DIR)
+    if backend == "sqlite":
+        store = SQLiteConversationStore(LOG_DB_PATH)
+        store.migrate_from_json(LOG_DIR)
+        return store
+    raise ValueError(f"Unknown log backend: {backend}")
@@ -0,0 +1,128 @@
+import re
+import threading
+from collections import deque
+
+# Generic decoy documents kept ready, by category. The keywords decide which emails
+# a category answers, and the seed is the request the PDF content is generated for.
+DECOY_CATEGORIES = {
+    "proof_of_payment": {
+        "keywords": ["proof of payment", "payment proof", "payment confirmation", "transfer confirmation",
+                     "bank slip", "transfer receipt", "swift copy"],
+        "name": "Payment_Confirmation",
+        "title": "Payment Confirmation",
+        "subtitle": "Dawson Tech",
+        "section": "Transfer details",
+        "seed": "Please send me the proof of payment for the transfer you made.",
+    },
+    "invoice": {
+        "keywords": ["invoice", "billing", "receipt"],
+        "name": "Invoice",
+        "title": "Invoice",
+        "subtitle": "Dawson Tech",
+        "section": "Invoice details",
+        "seed": "Please send me the invoice for the payment we discussed.",
+    },
+    "contract": {
+        "keywords": ["contract", "agreement", "signed terms"],
+        "name": "Agreement",
+        "title": "Agreement",
+        "subtitle": "Dawson Tech",
+        "section": "Terms",
+        "seed": "Please send me the signed contract for our agreement.",
+    },
+}
+
+
+class DecoyPool:
+    """
+    A pool of pre-rendered generic decoy PDFs, each carrying a fresh token, so that
+    emails asking for a common kind of document get a PDF without waiting for the
+    LLM and rendering. A background thread keeps each category at the target depth.
+    """
+
+    def __init__(self, generate_token, generate_content, render, depth=2, retry_interval=60):
+        """
+        Initialize the pool.
+        :param generate_token: Function returning a fresh token.
+        :param generate_content: Function taking a seed email and returning the PDF text, or None.
+        :param render: Function taking (token, content, title, subtitle, section) and returning PDF bytes.
+        :param depth: The number of decoys kept ready per category.
+        :param retry_interval: The number of seconds to wait after a failed generation.
+        """
+        self.generate_token = generate_token
+        self.generate_content = generate_content
+        self.render = render
+        self.depth = depth
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.pools = {category: deque() for category in DECOY_CATEGORIES}
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.patterns = {
+            category: re.compile(r'\b(' + '|'.join(re.escape(k) for k in spec["keywords"]) + r')s?\b', re.IGNORECASE)
+            for category, spec in DECOY_CATEGORIES.items()
+        }
+
+    def match_category(self, body):
+        """
+        Find the decoy category an email asks for.
+        :param body: The email body.
+        :return: The category, or None if no category matches.
+        """
+        for category, pattern in self.patterns.items():
+            if pattern.search(body):
+                return category
+        return None
+
+    def take(self, body):
+        """
+        Take a ready decoy matching an email.
+        :param body: The email body.
+        :return: A (token, filename, data) tuple, or None if no category matches or its pool is empty.
+        """
+        category = self.match_category(body)
+        if category is None:
+            return None
+        with self.lock:
+            decoy = self.pools[category].popleft() if self.pools[category] else None
+        self.wakeup.set()
+        if decoy is not None:
+            print(f"Using a pre-rendered {category} decoy.")
+        return decoy
+
+    def start(self):
+        """Start the background refiller thread."""
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.refill_forever, name="decoy-refiller", daemon=True)
+            self.thread.start()
+
+    def refill_forever(self):
+        while True:
+            self.wakeup.clear()
+            if not self.refill():
+                self.wakeup.wait(self.retry_interval)
+            else:
+                self.wakeup.wait()
+
+    def refill(self):
+        """
+        Generate decoys until every category is at the target depth.
+        :return: True if all categories are full, False if a generation failed.
+        """
+        for category, spec in DECOY_CATEGORIES.items():
+            while True:
+                with self.lock:
+                    if len(self.pools[category]) >= self.depth:
+                        break
+                try:
+                    content = self.generate_content(spec["seed"])
+                    if content is None:
+                        return False
+                    token = self.generate_token()
+                    data = self.render(token, content, spec["title"], spec["subtitle"], spec["section"])
+                except Exception as error:
+                    print(f"An error occurred while generating a {category} decoy: {error}")
+                    return False
+                with self.lock:
+                    self.pools[category].append((token, spec["name"] + '.pdf', data))
+        return True
@@ -9,26 +9,34 @@ from reportlab.lib.colors import blue
 import datetime
 from pikepdf import Pdf, Page, Encryption
 import uuid
-import honeytoken_service as honeytoken
-import openai_service as openai
 import dotenv
+from service_container import services
 
 dotenv.load_dotenv()
 
 address = os.getenv('API_URL')
 
-client = openai.OpenAIClient()
+def get_client():
+    # Built on first use and shared with the rest of the process; PDF render workers never build one
+    return services.openai()
 
 
-def update_url(token, name):
-    path='templates/template.pdf'
-    pdf = Pdf.open(path)
+# The template is read once and every PDF is built from it in memory
+TEMPLATE_PATH = 'templates/template.pdf'
+template_bytes = None
+
+
+def load_template(path=TEMPLATE_PATH):
+    global template_bytes
+    if template_bytes is None:
+        with open(path, 'rb') as f:
+            template_bytes = f.read()
+    return template_bytes
+
+def update_url(pdf, token):
     Page(pdf.pages[0]).obj['/AA']['/O']['/URI'] = address + '/' + token
-    pdf.save('../pdf_files/' + name + '.pdf')
 
-def insert_text(name, body, title, subTitle, section, token):
-    response = client.fill_pdf(body)
-    
+def insert_text(pdf, content, title, subTitle, section):
     packet = io.BytesIO()
     can = canvas.Canvas(packet)
     PAGE_WIDTH = defaultPageSize[0]
@@ -50,7 +58,7 @@ def insert_text(name, body, title, subTitle, section, token):
     can.line(40,605,PAGE_WIDTH-40,605)
 
     can.setFont("Helvetica",12)
-    L = simpleSplit(response, can._fontname, can._fontsize, PAGE_WIDTH - 80)
+    L = simpleSplit(content, can._fontname, can._fontsize, PAGE_WIDTH - 80)
     x=40
     y=580
     for t in L:
@@ -60,17 +68,13 @@ def insert_text(name, body, title, subTitle, section, token):
     can.save()
     packet.seek(0)
 
-    token_pdf = Pdf.open('../pdf_files/' + name + '.pdf', allow_overwriting_input=True)
     text_pdf = Pdf.open(packet)
-    token_pdf_page = Page(token_pdf.pages[0])
+    token_pdf_page = Page(pdf.pages[0])
     text_pdf_page = Page(text_pdf.pages[0])
 
     token_pdf_page.add_overlay(text_pdf_page)
-    token_pdf.save()
-
-def update_metadata(name):
-   pdf = Pdf.open('../pdf_files/'+name+'.pdf',allow_overwriting_input=True)
 
+def update_metadata(pdf):
    with pdf.open_metadata(set_pikepdf_as_editor=False) as meta:
     meta['pdf:Producer'] ='Adobe PDF Library 23.1.96'
     meta['xmp:CreatorTool'] = 'Acrobat PDFMaker 23 for Word'  
@@ -79,8 +83,16 @@ def update_metadata(name):
     meta['xmp:MetadataDate'] = get_mod_date()
     meta['xmpMM:DocumentID'] = str(uuid.uuid4())
     meta['xmpMM:InstanceID'] = str(uuid.uuid4())
-    
-    pdf.save(encryption=Encryption(''))
+
+def render_pdf(token, content, title, subtitle, section):
+    # URI patch, text overlay and metadata on one document, serialized once
+    pdf = Pdf.open(io.BytesIO(load_template()))
+    update_url(pdf, token)
+    insert_text(pdf, content, title, subtitle, section)
+    update_metadata(pdf)
+    output = io.BytesIO()
+    pdf.save(output, encryption=Encryption(''))
+    return output.getvalue()
 
 def get_creation_date():
     time = datetime.datetime.now()
@@ -93,11 +105,13 @@ def get_mod_date():
     stamp = time.strftime('%Y-%m-%d')+'T'+time.strftime('%H:%M:%S')
     return stamp
 
-def generate_pdf(token, body, title, subtitle, section):
-    name = client.generate_pdf_name(body)
+def generate_pdf(token, body, title, subtitle, section, name=None, content=None, render=render_pdf):
+    # The name and content are generated here unless they came with the reply
+    if name == None:
+        name = get_client().generate_pdf_name(body)
     if name == None:
         name = 'info'
-    update_url(token, name)
-    insert_text(name,body,title,subtitle,section,token)
-    update_metadata(name)
-    return '../pdf_files/'+ name +'.pdf'
+    if content == None:
+        content = get_client().fill_pdf(body)
+    data = render(token, content, title, subtitle, section)
+    return name + '.pdf', data
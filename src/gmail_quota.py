@@ -0,0 +1,207 @@
+import random
+import threading
+import time
+from collections import deque
+from googleapiclient.errors import HttpError
+from rate_limiter import TokenBucket
+
+# Quota units Gmail charges per method
+METHOD_COSTS = {
+    "messages.send": 100,
+    "messages.get": 5,
+    "messages.list": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "history.list": 2,
+    "threads.get": 10,
+    "getProfile": 1,
+}
+DEFAULT_COST = 5
+
+# Methods on the reply path, served before background polling when quota is short
+INTERACTIVE_METHODS = {"messages.send"}
+
+# Transient server errors, retried with backoff
+RETRYABLE_STATUSES = {500, 502, 503, 504}
+
+# Methods that may have taken effect when they fail with a server error, so they are
+# only retried after rate limit errors, which Gmail rejects without acting on them
+NON_IDEMPOTENT_METHODS = {"messages.send"}
+
+# Reasons Gmail gives with a 403 when the caller is over a rate limit
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class GmailQuotaScheduler:
+    """
+    Central scheduler for Gmail API calls. Calls spend quota units from a token bucket
+    refilled at the per-user rate limit, interactive calls (sends) go before background
+    calls (polling) when they wait at the same time, and rate limit errors pause every
+    caller for the Retry-After delay or an exponential backoff.
+    """
+
+    def __init__(self, units_per_second=250, max_retries=5, max_backoff=64, window=60):
+        """
+        Initialize the scheduler.
+        :param units_per_second: The per-user quota, in units per second.
+        :param max_retries: The number of times a rate limited or failed call is retried.
+        :param max_backoff: The maximum number of seconds between retries.
+        :param window: The number of seconds over which the recent usage is measured.
+        """
+        self.units_per_second = units_per_second
+        self.bucket = TokenBucket(units_per_second, units_per_second)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.window = window
+        self.condition = threading.Condition()
+        self.interactive_waiting = 0
+        # Time before which no call is made, after a rate limit error
+        self.blocked_until = 0.0
+
+        self.stats_lock = threading.Lock()
+        self.usage = {}
+        self.recent = deque()
+
+    @staticmethod
+    def cost(method):
+        return METHOD_COSTS.get(method, DEFAULT_COST)
+
+    def acquire(self, units, interactive=False):
+        """
+        Wait until the quota units are available. Calls costing more than the bucket holds,
+        like large batch requests, are charged in bucket-sized chunks.
+        :param units: The number of units the call costs.
+        :param interactive: Whether the call goes before background calls.
+        :return: The number of seconds waited.
+        """
+        start = time.monotonic()
+        remaining = units
+        with self.condition:
+            if interactive:
+                self.interactive_waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now < self.blocked_until:
+                        delay = self.blocked_until - now
+                    elif not interactive and self.interactive_waiting:
+                        # Woken up when the interactive calls got their units
+                        delay = None
+                    else:
+                        chunk = min(remaining, self.bucket.capacity)
+                        delay = self.bucket.try_acquire(chunk)
+                        if delay == 0:
+                            remaining -= chunk
+                            if remaining <= 0:
+                                break
+                            continue
+                    self.condition.wait(delay)
+            finally:
+                if interactive:
+                    self.interactive_waiting -= 1
+                    self.condition.notify_all()
+        return time.monotonic() - start
+
+    @staticmethod
+    def is_rate_limit(error):
+        """Check if an error means the caller is over a Gmail rate limit."""
+        if not isinstance(error, HttpError):
+            return False
+        if error.resp.status == 429:
+            return True
+        content = error.content.decode(errors="replace") if isinstance(error.content, bytes) else str(error.content)
+        return error.resp.status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+    def retry_delay(self, error, attempt):
+        """
+        Get the delay before retrying a failed call: the Retry-After header if there is one,
+        otherwise an exponential backoff with full jitter.
+        """
+        retry_after = error.resp.get("retry-after") if isinstance(error, HttpError) else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, 2 ** attempt))
+
+    def throttle(self, method, error, attempt=0):
+        """
+        Pause every caller after a rate limit error.
+        :param method: The method that was rate limited.
+        :param error: The rate limit error.
+        :param attempt: The number of retries made so far.
+        :return: The pause, in seconds.
+        """
+        delay = self.retry_delay(error, attempt)
+        with self.condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.count(method, throttled=1)
+        print(f"Gmail rate limit hit on {method}, pausing requests for {delay:.1f} seconds.")
+        return delay
+
+    def execute(self, method, request, calls=1, interactive=None, retry=True):
+        """
+        Execute a Gmail API request once its quota units are available.
+        :param method: The method name, e.g. "messages.get", used for its cost and counters.
+        :param request: The request (or batch request) to execute.
+        :param calls: The number of calls the request holds, for batch requests.
+        :param interactive: Whether the call goes before background calls; by default, sends do.
+        :param retry: Whether the request may be executed again after an error; non-idempotent
+                      methods are only retried after rate limit errors.
+        :return: The response.
+        :raises HttpError: When the call fails with a non-retryable error or after the last retry.
+        """
+        if interactive is None:
+            interactive = method in INTERACTIVE_METHODS
+        units = self.cost(method) * calls
+        attempt = 0
+        while True:
+            waited = self.acquire(units, interactive)
+            self.count(method, calls=calls, units=units, waited=waited)
+            try:
+                return request.execute()
+            except HttpError as error:
+                rate_limited = self.is_rate_limit(error)
+                transient = error.resp.status in RETRYABLE_STATUSES and method not in NON_IDEMPOTENT_METHODS
+                if not retry or attempt >= self.max_retries or not (rate_limited or transient):
+                    if rate_limited:
+                        self.throttle(method, error, attempt)
+                    raise
+                if rate_limited:
+                    self.throttle(method, error, attempt)
+                else:
+                    time.sleep(self.retry_delay(error, attempt))
+                self.count(method, retries=1)
+                attempt += 1
+
+    def count(self, method, calls=0, units=0, waited=0.0, throttled=0, retries=0):
+        with self.stats_lock:
+            usage = self.usage.setdefault(
+                method, {"calls": 0, "units": 0, "waited": 0.0, "throttled": 0, "retries": 0}
+            )
+            usage["calls"] += calls
+            usage["units"] += units
+            usage["waited"] += waited
+            usage["throttled"] += throttled
+            usage["retries"] += retries
+            if units:
+                self.recent.append((time.monotonic(), units))
+
+    def stats(self):
+        """
+        Get the usage statistics.
+        :return: A dictionary with the per-method counters (calls, units, seconds waited for quota,
+                 rate limit errors, retries), the units per second used over the recent window,
+                 and the quota limit.
+        """
+        with self.stats_lock:
+            cutoff = time.monotonic() - self.window
+            while self.recent and self.recent[0][0] < cutoff:
+                self.recent.popleft()
+            recent_units = sum(units for _, units in self.recent)
+            return {
+                "methods": {method: dict(usage) for method, usage in self.usage.items()},
+                "units_per_second": recent_units / self.window,
+                "limit": self.units_per_second,
+            }
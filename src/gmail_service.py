@@ -1,6 +1,8 @@
 from __future__ import print_function
 import os
+import json
 import base64
+import threading
 import mimetypes
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -13,7 +15,76 @@ from email.utils import parseaddr
 from google.auth.transport.requests import Request
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
+from google_auth_httplib2 import AuthorizedHttp
+import requests
+from gmail_quota import GmailQuotaScheduler
+from send_coalescer import SendCoalescer
+from message_cache import MessageCache
+
+# Gmail accepts at most 100 calls per batch request
+MAX_BATCH_SIZE = 100
+
+# messages.batchModify accepts at most 1000 message IDs
+MAX_MODIFY_IDS = 1000
+
+# Fields of a message needed to reply to it in its thread
+REPLY_HEADER_KEYS = ('threadId', 'message_id', 'from', 'subject')
+
+# Local copy of the Gmail API discovery document, so that services are built without the network
+DISCOVERY_CACHE_PATH = os.getenv('GMAIL_DISCOVERY_CACHE_PATH', 'gmail_discovery.json')
+DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+
+def load_discovery_document(path=DISCOVERY_CACHE_PATH):
+    """
+    Load the Gmail API discovery document from its local copy. The first time, the copy is made
+    from the document shipped with google-api-python-client, or downloaded if there is none.
+
+    Args:
+        path (str): The path of the local copy.
+
+    Returns:
+        str: The discovery document as JSON.
+    """
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            return file.read()
+
+    document = get_static_doc('gmail', 'v1')
+    if document is None:
+        response = requests.get(DISCOVERY_URL, timeout=30)
+        response.raise_for_status()
+        document = response.text
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(document)
+    os.replace(temp_path, path)
+    return document
+
+class SharedCredentials(Credentials):
+    """
+    OAuth credentials shared by the Gmail services of all threads.
+    Refreshes are serialized, so that when several threads find the token expired at the
+    same time only the first one refreshes it, and the new token is saved to the token file.
+    """
+
+    refresh_lock = threading.Lock()
+    token_file = None
+
+    def refresh(self, request):
+        stale_token = self.token
+        with self.refresh_lock:
+            # Another thread refreshed the token while this one was waiting
+            if self.token != stale_token and self.valid:
+                return
+            super().refresh(request)
+            if self.token_file:
+                with open(self.token_file, 'w') as token:
+                    token.write(self.to_json())
 
 class GmailService:
     """A class to interact with the Gmail API."""
@@ -37,27 +108,83 @@ class GmailService:
             'https://www.googleapis.com/auth/gmail.readonly',
             'https://www.googleapis.com/auth/gmail.modify'
         ]
-        self.service = self.authenticate()
+        self.credentials = self.authenticate()
+        self.discovery_document = load_discovery_document()
+
+        # httplib2 is not thread-safe, so each thread gets its own service and HTTP connection
+        self.local = threading.local()
+
+        # Every API call goes through the quota scheduler
+        self.quota = GmailQuotaScheduler(
+            units_per_second=float(os.getenv('GMAIL_QUOTA_UNITS_PER_SECOND', '250')),
+            max_retries=int(os.getenv('GMAIL_MAX_RETRIES', '5'))
+        )
+
+        # Replies sent by concurrent threads within GMAIL_SEND_BATCH_WINDOW seconds share one batch request
+        self.sends = SendCoalescer(
+            self.send_batch,
+            max_batch=min(int(os.getenv('GMAIL_SEND_BATCH_SIZE', '20')), MAX_BATCH_SIZE),
+            window=float(os.getenv('GMAIL_SEND_BATCH_WINDOW', '0.2'))
+        )
+
+        # Parsed messages, shared by every read path
+        self.messages = MessageCache(
+            max_entries=int(os.getenv('GMAIL_MESSAGE_CACHE_SIZE', '1000')),
+            ttl=int(os.getenv('GMAIL_MESSAGE_CACHE_TTL', '600'))
+        )
+
+        # Number of message fetches sent per batch HTTP request
+        self.batch_size = min(int(os.getenv('GMAIL_BATCH_SIZE', '50')), MAX_BATCH_SIZE)
+
+        # File holding the mailbox historyId reached by the last incremental sync
+        self.history_file = os.getenv('HISTORY_FILE_PATH', 'gmail_history.json')
 
     def authenticate(self):
-        """Authenticate using stored credentials and return a Gmail API service instance."""
+        """Authenticate using stored credentials and return the credentials shared by all threads."""
         creds = None
         if os.path.exists(self.token_file):
-            creds = Credentials.from_authorized_user_file(self.token_file, self.SCOPES)
+            creds = SharedCredentials.from_authorized_user_file(self.token_file, self.SCOPES)
+            creds.token_file = self.token_file
         
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
+                # Saves the updated credentials
                 creds.refresh(Request())
             else:
                 raise Exception("Invalid credentials or token. Please generate a new token.")
         
-            # Save updated credentials
-            with open(self.token_file, 'w') as token:
-                token.write(creds.to_json())
-        
-        service = build('gmail', 'v1', credentials=creds)
+        return creds
+
+    @property
+    def service(self):
+        """The Gmail API service instance of the calling thread, built from the local discovery document."""
+        service = getattr(self.local, 'service', None)
+        if service is None:
+            http = AuthorizedHttp(self.credentials, http=build_http())
+            service = build_from_document(self.discovery_document, http=http)
+            self.local.service = service
         return service
     
+    def quota_stats(self):
+        """
+        Get the Gmail API usage statistics.
+        
+        Returns:
+            A dictionary with the per-method counters, the units per second used recently
+            and the per-user quota.
+        """
+        return self.quota.stats()
+
+    def message_cache_stats(self):
+        """
+        Get the message cache statistics.
+        
+        Returns:
+            A dictionary with the hit and miss counts, the hit rate, the number of
+            invalidated messages and the number of cached messages.
+        """
+        return self.messages.stats()
+
     def append_signature(self, body, token):
         """
         Appends the signature to the email body while preserving its formatting.
@@ -141,7 +268,9 @@ class GmailService:
     def send_message(self, user_id, message):
         """Send an email message via the Gmail API."""
         try:
-            sent_message = self.service.users().messages().send(userId=user_id, body=message).execute()
+            sent_message = self.quota.execute(
+                'messages.send', self.service.users().messages().send(userId=user_id, body=message)
+            )
             print(f'Email sent successfully! Message Id: {sent_message["id"]}')
             return sent_message
         except Exception as error:
@@ -159,40 +288,113 @@ class GmailService:
     def list_messages(self, user_id='me', query=''):
         """List all messages of the user's mailbox matching the query."""
         try:
-            response = self.service.users().messages().list(userId=user_id, q=query).execute()
+            response = self.quota.execute('messages.list', self.service.users().messages().list(userId=user_id, q=query))
             messages = []
             if 'messages' in response:
                 messages.extend(response['messages'])
             while 'nextPageToken' in response:
                 page_token = response['nextPageToken']
-                response = self.service.users().messages().list(userId=user_id, q=query, pageToken=page_token).execute()
+                response = self.quota.execute(
+                    'messages.list', self.service.users().messages().list(userId=user_id, q=query, pageToken=page_token)
+                )
                 messages.extend(response['messages'])
             return messages
         except Exception as error:
             print(f'An error occurred: {error}')
             return None
 
+    def extract_body(self, message):
+        """Decode the text/plain content of a full-format message."""
+        body = ""
+        if 'parts' in message['payload']:  # Handle multipart messages
+            for part in message['payload']['parts']:
+                if part['mimeType'] == 'text/plain' and 'data' in part['body']:
+                    body += base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+        else:  # Handle single-part messages
+            body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8')
+        return body
+
     def get_message_details(self, user_id, msg_id):
         """Get detailed information of a specific message, including the entire body content."""
+        message = self.messages.get(msg_id)
+        if message is not None:
+            return message
         try:
-            message = self.service.users().messages().get(userId=user_id, id=msg_id, format='full').execute()
-            
-            # Extract message body
-            body = ""
-            if 'parts' in message['payload']:  # Handle multipart messages
-                for part in message['payload']['parts']:
-                    if part['mimeType'] == 'text/plain' and 'data' in part['body']:
-                        body += base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-            else:  # Handle single-part messages
-                body = base64.urlsafe_b64decode(message['payload']['body']['data']).decode('utf-8')
+            message = self.quota.execute(
+                'messages.get', self.service.users().messages().get(userId=user_id, id=msg_id, format='full')
+            )
             
             # Add the full body content to the message details
-            message['full_body'] = body
+            message['full_body'] = self.extract_body(message)
+            self.messages.put(msg_id, message)
             return message
         except Exception as error:
             print(f'An error occurred: {error}')
             return None
 
+    def get_messages_details(self, user_id, msg_ids, batch_size=None, msg_format='full', metadata_headers=None):
+        """
+        Get detailed information of several messages from the message cache, sending
+        the fetches of the others through Gmail batch HTTP requests instead of one
+        round trip per message.
+        
+        Args:
+            user_id: The Gmail user ID (usually 'me').
+            msg_ids: The IDs of the messages to fetch.
+            batch_size: Number of fetches per batch request (defaults to GMAIL_BATCH_SIZE).
+            msg_format: The Gmail message format, 'full' or 'metadata'.
+            metadata_headers: The headers to return with the 'metadata' format.
+            
+        Returns:
+            A dictionary mapping each message ID to its details, including 'full_body'
+            for the 'full' format.
+            Messages that no longer exist map to None; messages that could not be
+            fetched or decoded for any other reason are left out.
+        """
+        batch_size = min(batch_size or self.batch_size, MAX_BATCH_SIZE)
+        details = {}
+        for msg_id in msg_ids:
+            message = self.messages.get(msg_id, msg_format, metadata_headers)
+            if message is not None:
+                details[msg_id] = message
+        msg_ids = [msg_id for msg_id in msg_ids if msg_id not in details]
+
+        def handle_response(request_id, response, exception):
+            if exception is not None:
+                print(f'An error occurred while fetching message {request_id}: {exception}')
+                if self.quota.is_rate_limit(exception):
+                    self.quota.throttle('messages.get', exception)
+                elif isinstance(exception, HttpError) and exception.resp.status == 404:
+                    self.messages.invalidate([request_id])
+                    details[request_id] = None
+                return
+            if msg_format == 'full':
+                try:
+                    response['full_body'] = self.extract_body(response)
+                except Exception as error:
+                    print(f'An error occurred while decoding message {request_id}: {error}')
+                    return
+            self.messages.put(request_id, response, msg_format, metadata_headers)
+            details[request_id] = response
+
+        for start in range(0, len(msg_ids), batch_size):
+            batch = self.service.new_batch_http_request(callback=handle_response)
+            chunk = msg_ids[start:start + batch_size]
+            for msg_id in chunk:
+                batch.add(
+                    self.service.users().messages().get(
+                        userId=user_id, id=msg_id, format=msg_format, metadataHeaders=metadata_headers
+                    ),
+                    request_id=msg_id
+                )
+            try:
+                # A batch request is charged as the calls it holds
+                self.quota.execute('messages.get', batch, calls=len(chunk), retry=False)
+            except Exception as error:
+                print(f'An error occurred while executing the batch request: {error}')
+
+        return details
+
     def get_latest_message_content(self, message):
         """
         Extract the latest email content from the full message body and format newlines for JSON.
@@ -218,7 +420,173 @@ class GmailService:
 
         return formatted_content
 
-    def check_for_new_emails(self, user_id='me', query='is:unread', include_spam=False):
+    def load_sync_state(self):
+        """
+        Load the incremental sync state.
+        
+        Returns:
+            A dictionary with the last synced 'history_id' (None before the first sync)
+            and the 'pending' message IDs whose details could not be fetched yet.
+        """
+        if os.path.exists(self.history_file):
+            with open(self.history_file, 'r') as file:
+                state = json.load(file)
+            return {"history_id": state.get("history_id"), "pending": state.get("pending", [])}
+        return {"history_id": None, "pending": []}
+
+    def save_sync_state(self, history_id, pending):
+        """Durably save the incremental sync state (write to a temporary file, fsync, rename)."""
+        temp_file = self.history_file + '.tmp'
+        with open(temp_file, 'w') as file:
+            json.dump({"history_id": history_id, "pending": pending}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, self.history_file)
+
+    def get_current_history_id(self, user_id='me'):
+        """Get the current historyId of the mailbox."""
+        profile = self.quota.execute('getProfile', self.service.users().getProfile(userId=user_id))
+        return profile['historyId']
+
+    def list_added_messages(self, user_id, start_history_id, include_spam=False):
+        """
+        List the unread messages added to the mailbox since a historyId.
+        Label changes and deletions in the history are applied to the message cache.
+        
+        Args:
+            user_id: The Gmail user ID (usually 'me').
+            start_history_id: The historyId to list changes from.
+            include_spam: Boolean indicating if messages added to spam should be included.
+            
+        Returns:
+            A tuple of (message IDs, latest historyId).
+            
+        Raises:
+            HttpError: With status 404 when start_history_id is too old to be used.
+        """
+        msg_ids = []
+        latest_history_id = start_history_id
+        page_token = None
+        while True:
+            response = self.quota.execute('history.list', self.service.users().history().list(
+                userId=user_id,
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved'],
+                pageToken=page_token
+            ))
+            for record in response.get('history', []):
+                for change in record.get('labelsAdded', []):
+                    self.messages.label_changed(change['message']['id'], added=change.get('labelIds', []))
+                for change in record.get('labelsRemoved', []):
+                    self.messages.label_changed(change['message']['id'], removed=change.get('labelIds', []))
+                self.messages.invalidate([deleted['message']['id'] for deleted in record.get('messagesDeleted', [])])
+                for added in record.get('messagesAdded', []):
+                    labels = added['message'].get('labelIds', [])
+                    if 'UNREAD' not in labels:
+                        continue
+                    if 'INBOX' in labels or (include_spam and 'SPAM' in labels):
+                        if added['message']['id'] not in msg_ids:
+                            msg_ids.append(added['message']['id'])
+            latest_history_id = response.get('historyId', latest_history_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return msg_ids, latest_history_id
+
+    def sync_new_messages(self, user_id='me', query='is:unread', include_spam=False):
+        """
+        Get the IDs of new unread messages since the last sync.
+        Only the messages added since the stored historyId are fetched; a full
+        query is made on the first sync and when the stored historyId has expired.
+        
+        Args:
+            user_id: The Gmail user ID (usually 'me').
+            query: Search query used for a full resync.
+            include_spam: Boolean indicating if spam emails should be included.
+            
+        Returns:
+            A tuple of (message IDs, historyId to save together with the messages left to handle).
+        """
+        state = self.load_sync_state()
+        history_id = state['history_id']
+
+        if history_id is not None:
+            try:
+                msg_ids, latest_history_id = self.list_added_messages(user_id, history_id, include_spam)
+                return state['pending'] + [msg_id for msg_id in msg_ids if msg_id not in state['pending']], latest_history_id
+            except HttpError as error:
+                if error.resp.status != 404:
+                    raise
+                print(f"History ID {history_id} has expired, running a full resync.")
+
+        # Label changes before now cannot be seen, so cached messages may be out of date
+        self.messages.clear()
+
+        # Read the historyId before listing so that nothing added in between is missed
+        latest_history_id = self.get_current_history_id(user_id)
+        if include_spam:
+            query += ' in:spam'
+        messages = self.list_messages(user_id=user_id, query=query) or []
+        return [message['id'] for message in messages], latest_history_id
+
+    def get_header(self, message, name):
+        """Get the value of a header of a message, or None if it is missing."""
+        name = name.lower()
+        return next((header['value'] for header in message['payload']['headers'] if header['name'].lower() == name), None)
+
+    def get_reply_headers(self, email):
+        """
+        Get the fields needed to reply to an email in its thread.
+        
+        Args:
+            email: Either a dictionary already holding the fields (as returned by
+                check_for_new_emails or stored with a queued reply), the full details of
+                a message, or a dictionary with only the message "id", which is fetched.
+            
+        Returns:
+            A dictionary with 'threadId', 'message_id', 'from' and 'subject',
+            or None if the message could not be fetched.
+        """
+        if all(key in email for key in REPLY_HEADER_KEYS):
+            return {key: email[key] for key in REPLY_HEADER_KEYS}
+        message = email if 'payload' in email else self.get_email_from_id(email['id'])
+        if message is None:
+            return None
+        return {
+            'threadId': message['threadId'],
+            'message_id': self.get_header(message, 'Message-ID'),
+            'from': self.get_header(message, 'From'),
+            'subject': self.get_header(message, 'Subject') or ''
+        }
+
+    def triage_messages(self, user_id, msg_ids, sender_filter, batch_size=None):
+        """
+        Select the messages worth a full download by fetching only their From and
+        Subject headers and checking the sender.
+        
+        Args:
+            user_id: The Gmail user ID (usually 'me').
+            msg_ids: The IDs of the messages to triage.
+            sender_filter: A function taking a sender email address and returning
+                True if the message should be processed.
+            batch_size: Number of fetches per batch request (defaults to GMAIL_BATCH_SIZE).
+            
+        Returns:
+            A tuple of (IDs of the selected messages, metadata dictionary as returned
+            by get_messages_details).
+        """
+        metadata = self.get_messages_details(
+            user_id, msg_ids, batch_size, msg_format='metadata', metadata_headers=['From', 'Subject']
+        )
+        selected = []
+        for msg_id in msg_ids:
+            if metadata.get(msg_id) is None:
+                continue
+            sender_email = parseaddr(self.get_header(metadata[msg_id], 'From'))[1]
+            if sender_filter(sender_email):
+                selected.append(msg_id)
+        return selected, metadata
+
+    def check_for_new_emails(self, user_id='me', query='is:unread', include_spam=False, batch_size=None, incremental=False, sender_filter=None):
         """
         Check for new unread emails, optionally including spam, and return a list of email details.
         
@@ -226,40 +594,87 @@ class GmailService:
             user_id: The Gmail user ID (usually 'me').
             query: Search query to filter messages (default is 'is:unread' for unread messages).
             include_spam: Boolean indicating if spam emails should be included.
+            batch_size: Number of message fetches per batch request (defaults to GMAIL_BATCH_SIZE).
+            incremental: Boolean indicating if only messages added since the last
+                incremental check should be fetched, using the mailbox history.
+            sender_filter: Optional function taking a sender email address and returning
+                True if the message should be returned. When given, only the headers of
+                the other messages are downloaded.
             
         Returns:
             A list of dictionaries, each containing details about a new email.
             If no new emails are found, returns an empty list.
+            With incremental checks, the returned emails stay pending, and are returned
+            again by the next check, until they are passed to acknowledge_emails.
         """
-        if include_spam:
-            query += ' in:spam'
+        if incremental:
+            try:
+                msg_ids, history_id = self.sync_new_messages(user_id, query, include_spam)
+            except Exception as error:
+                print(f'An error occurred while syncing the mailbox: {error}')
+                return []
+        else:
+            if include_spam:
+                query += ' in:spam'
+            messages = self.list_messages(user_id=user_id, query=query)
+            msg_ids = [message['id'] for message in messages] if messages else []
         
         new_emails = []
-        messages = self.list_messages(user_id=user_id, query=query)
+        details = {}
         
-        if messages:
-            for message in messages:
-                msg_id = message['id']
-                msg_details = self.get_message_details(user_id, msg_id)
-
-                # Extract the sender and format it as only the email address
-                raw_sender = next((header['value'] for header in msg_details['payload']['headers'] if header['name'] == 'From'), None)
-                sender_email = parseaddr(raw_sender)[1]  # Extract only the email address
-
-                body = self.get_latest_message_content(msg_details)
-                
-                # Append the email with the full message body
-                new_emails.append({
-                    "id": msg_id,
-                    "threadId": msg_details.get('threadId'),
-                    "sender": sender_email,
-                    "subject": next((header['value'] for header in msg_details['payload']['headers'] if header['name'] == 'Subject'), None),
-                    "body": body,
-                    "timestamp": msg_details.get('internalDate')
-                })
+        if msg_ids and sender_filter is not None:
+            selected, metadata = self.triage_messages(user_id, msg_ids, sender_filter, batch_size)
+            # Messages from other senders are settled without downloading their bodies
+            details = {msg_id: None for msg_id in metadata if msg_id not in selected}
+            details.update(self.get_messages_details(user_id, selected, batch_size))
+        elif msg_ids:
+            details = self.get_messages_details(user_id, msg_ids, batch_size)
+
+        for msg_id in msg_ids:
+            msg_details = details.get(msg_id)
+            if msg_details is None:
+                # Left unread (and pending for incremental checks if it failed), so it is picked up again
+                continue
+
+            # Extract the sender and format it as only the email address
+            raw_sender = self.get_header(msg_details, 'From')
+            sender_email = parseaddr(raw_sender)[1]  # Extract only the email address
+
+            body = self.get_latest_message_content(msg_details)
+            
+            # Append the email with the full message body
+            new_emails.append({
+                "id": msg_id,
+                "threadId": msg_details.get('threadId'),
+                "sender": sender_email,
+                "from": raw_sender,
+                "message_id": self.get_header(msg_details, 'Message-ID'),
+                "subject": self.get_header(msg_details, 'Subject') or '',
+                "body": body,
+                "timestamp": msg_details.get('internalDate')
+            })
+
+        if incremental:
+            # Only the messages settled without downloading their bodies are done with;
+            # the returned ones wait for the caller to handle them
+            self.save_sync_state(history_id, [msg_id for msg_id in msg_ids if details.get(msg_id, True) is not None])
         
         return new_emails
 
+    def acknowledge_emails(self, msg_ids):
+        """
+        Remove handled emails from the pending messages of the incremental sync, so that
+        the next incremental check does not return them again.
+        
+        Args:
+            msg_ids: The IDs of the handled emails.
+        """
+        acknowledged = set(msg_ids)
+        state = self.load_sync_state()
+        pending = [msg_id for msg_id in state['pending'] if msg_id not in acknowledged]
+        if len(pending) != len(state['pending']):
+            self.save_sync_state(state['history_id'], pending)
+
     def find_message_by_sender_and_subject(self, sender, subject):
         """
         Search for a message by sender and subject.
@@ -300,39 +715,34 @@ class GmailService:
     # Include the reply_to_message function as defined previously
     def reply_to_email(self, email, response_text, token=None):
         """
-        Reply to an existing email message in the same thread and mark it as read if successful.
+        Reply to an existing email message in the same thread.
         
         Args:
-            email: Dictionary containing the email details, including "id".
+            email: Dictionary containing the email "id", and its reply headers (see get_reply_headers)
+                unless they are to be fetched.
             response_text: The text content for the reply.
             token: Optional token to include in the signature as a clickable link.
             
         Returns:
             The response from the Gmail API if successful, otherwise None.
         """
-        message = self.get_email_from_id(email["id"])
+        # Only fetched from Gmail if the email does not carry its reply headers
+        headers = self.get_reply_headers(email)
 
         try:
-            thread_id = message['threadId']
-            headers = {header['name']: header['value'] for header in message['payload']['headers']}
-            message_id_header = headers.get('Message-ID')
-            from_email = headers.get('From')
+            thread_id = headers['threadId']
+            message_id_header = headers['message_id']
+            from_email = headers['from']
             
             if not from_email:
                 print("Error: 'From' email address not found in the original message.")
                 return None
             
-            # Mark email as read
-            res = self.mark_as_read('me', email['id'])
-            if res == -1:
-                print("Failed to mark the email as read.")
-                return None
-            
             # Add the signature with a clickable link if the token is provided
             if token:
                 response_text = self.append_signature(response_text, token)
 
-            subject = "Re: " + headers.get('Subject', '')
+            subject = "Re: " + (headers['subject'] or '')
 
             # Create the reply message in HTML format
             reply_message = MIMEText(response_text, 'html')  # 'html' ensures the signature link works as intended
@@ -345,10 +755,7 @@ class GmailService:
             raw_message = base64.urlsafe_b64encode(reply_message.as_bytes()).decode()
 
             # Send the reply within the original thread
-            send_response = self.service.users().messages().send(
-                userId='me',
-                body={'raw': raw_message, 'threadId': thread_id}
-            ).execute()
+            send_response = self.send_reply(raw_message, thread_id)
 
             print(f"Reply sent successfully! Message Id: {send_response}")
 
@@ -357,42 +764,38 @@ class GmailService:
             print(f"An error occurred: {error}")
             return None
         
-    def reply_to_email_with_attachment(self, email, response_text, attachment_path, token=None):
+    def reply_to_email_with_attachment(self, email, response_text, attachment, token=None, filename=None):
         """
         Reply to an existing email message in the same thread with an attachment and a clickable signature.
 
         Args:
-            email: Dictionary containing the email details, including "id".
+            email: Dictionary containing the email "id", and its reply headers (see get_reply_headers)
+                unless they are to be fetched.
             response_text: The text content for the reply.
-            attachment_path: The file path of the attachment to include.
+            attachment: The file path of the attachment to include, or its content as bytes.
             token: Optional token to include in the signature as a clickable link.
+            filename: The name of the attached file (defaults to the base name of the path).
 
         Returns:
             The response from the Gmail API if successful, otherwise None.
         """
-        message = self.get_email_from_id(email["id"])
+        # Only fetched from Gmail if the email does not carry its reply headers
+        headers = self.get_reply_headers(email)
 
         try:
-            thread_id = message['threadId']
-            headers = {header['name']: header['value'] for header in message['payload']['headers']}
-            message_id_header = headers.get('Message-ID')
-            from_email = headers.get('From')
+            thread_id = headers['threadId']
+            message_id_header = headers['message_id']
+            from_email = headers['from']
             
             if not from_email:
                 print("Error: 'From' email address not found in the original message.")
                 return None
-            
-            # Mark email as read
-            res = self.mark_as_read('me', email['id'])
-            if res == -1:
-                print("Failed to mark the email as read.")
-                return None
 
             # Add the signature with a clickable link if the token is provided
             if token:
                 response_text = self.append_signature(response_text, token)
 
-            subject = "Re: " + headers.get('Subject', '')
+            subject = "Re: " + (headers['subject'] or '')
 
             # Create a multipart email message to include both HTML body and attachment
             reply_message = MIMEMultipart()
@@ -405,28 +808,30 @@ class GmailService:
             body_part = MIMEText(response_text, 'html')
             reply_message.attach(body_part)
 
-            # Attach the file
-            content_type, encoding = mimetypes.guess_type(attachment_path)
+            # Attach the file, read from disk unless its content was given
+            if isinstance(attachment, bytes):
+                file_data = attachment
+            else:
+                with open(attachment, 'rb') as f:
+                    file_data = f.read()
+                filename = filename or os.path.basename(attachment)
+
+            content_type, encoding = mimetypes.guess_type(filename)
             if content_type is None or encoding is not None:
                 content_type = 'application/octet-stream'
             main_type, sub_type = content_type.split('/', 1)
 
-            with open(attachment_path, 'rb') as f:
-                file_data = f.read()
-            attachment = MIMEBase(main_type, sub_type)
-            attachment.set_payload(file_data)
-            encoders.encode_base64(attachment)
-            attachment.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment_path))
-            reply_message.attach(attachment)
+            attachment_part = MIMEBase(main_type, sub_type)
+            attachment_part.set_payload(file_data)
+            encoders.encode_base64(attachment_part)
+            attachment_part.add_header('Content-Disposition', 'attachment', filename=filename)
+            reply_message.attach(attachment_part)
 
             # Encode the message
             raw_message = base64.urlsafe_b64encode(reply_message.as_bytes()).decode()
 
             # Send the reply within the original thread
-            send_response = self.service.users().messages().send(
-                userId='me',
-                body={'raw': raw_message, 'threadId': thread_id}
-            ).execute()
+            send_response = self.send_reply(raw_message, thread_id)
 
             print(f"Reply with attachment and signature sent successfully! Message Id: {send_response['id']}")
             return send_response
@@ -436,14 +841,108 @@ class GmailService:
 
 
 
+    def send_reply(self, raw_message, thread_id):
+        """
+        Send a reply, batched with the replies other threads are sending at the same time.
+        
+        Args:
+            raw_message: The base64url-encoded message.
+            thread_id: The ID of the thread the reply belongs to.
+            
+        Returns:
+            The response from the Gmail API.
+        """
+        body = {'raw': raw_message, 'threadId': thread_id}
+        try:
+            return self.sends.submit(body).result()
+        except HttpError as error:
+            # Other errors do not mean the reply was not delivered, so it is not sent again here
+            if not self.quota.is_rate_limit(error):
+                raise
+            # Rejected by the rate limit: sent again on its own, with the scheduler's backoff
+            return self.quota.execute('messages.send', self.service.users().messages().send(userId='me', body=body))
+
+    def find_sent_reply(self, thread_id, in_reply_to, user_id='me'):
+        """
+        Find a reply already sent to a message, so that a reply whose sending failed
+        after it may have been delivered is not sent twice.
+        
+        Args:
+            thread_id: The ID of the thread of the message.
+            in_reply_to: The Message-ID header of the message.
+            user_id: The Gmail user ID (usually 'me').
+            
+        Returns:
+            The sent reply in the 'metadata' format, or None if there is none.
+        """
+        if not in_reply_to:
+            return None
+        thread = self.quota.execute('threads.get', self.service.users().threads().get(
+            userId=user_id, id=thread_id, format='metadata', metadataHeaders=['In-Reply-To']
+        ))
+        for message in thread.get('messages', []):
+            if 'SENT' in message.get('labelIds', []) and self.get_header(message, 'In-Reply-To') == in_reply_to:
+                return message
+        return None
+
+    def send_batch(self, bodies):
+        """
+        Send several messages in one batch HTTP request.
+        
+        Args:
+            bodies: The message bodies, each with 'raw' and 'threadId'.
+            
+        Returns:
+            A list with a (response, exception) tuple for each message, in order.
+        """
+        outcomes = {}
+
+        def handle_response(request_id, response, exception):
+            if exception is not None and self.quota.is_rate_limit(exception):
+                self.quota.throttle('messages.send', exception)
+            outcomes[request_id] = (response, exception)
+
+        batch = self.service.new_batch_http_request(callback=handle_response)
+        for index, body in enumerate(bodies):
+            batch.add(self.service.users().messages().send(userId='me', body=body), request_id=str(index))
+        self.quota.execute('messages.send', batch, calls=len(bodies), retry=False)
+        return [
+            outcomes.get(str(index), (None, Exception("No response in the batch request.")))
+            for index in range(len(bodies))
+        ]
+
+    def mark_as_read_batch(self, user_id, msg_ids):
+        """
+        Mark several messages as read with messages.batchModify calls.
+        
+        Args:
+            user_id: The Gmail user ID (usually 'me').
+            msg_ids: The IDs of the messages.
+            
+        Returns:
+            0 if all the messages were marked as read, -1 otherwise.
+        """
+        try:
+            for start in range(0, len(msg_ids), MAX_MODIFY_IDS):
+                self.quota.execute('messages.batchModify', self.service.users().messages().batchModify(
+                    userId=user_id,
+                    body={'ids': msg_ids[start:start + MAX_MODIFY_IDS], 'removeLabelIds': ['UNREAD']}
+                ))
+                self.messages.update_labels(msg_ids[start:start + MAX_MODIFY_IDS], removed=['UNREAD'])
+            return 0
+        except Exception as error:
+            print(f"An error occurred while marking messages as read: {error}")
+            return -1
+
     def mark_as_read(self, user_id, msg_id):
         """Mark a message as read."""
         try:
-            self.service.users().messages().modify(
+            self.quota.execute('messages.modify', self.service.users().messages().modify(
                 userId=user_id,
                 id=msg_id,
                 body={'removeLabelIds': ['UNREAD']}
-            ).execute()
+            ))
+            self.messages.update_labels([msg_id], removed=['UNREAD'])
             return 0
         except Exception as error:
             return -1
@@ -1,16 +1,40 @@
 import generatePDF as pdf
-import uuid
+import pdf_renderer
+import os
+import token_signing
+from decoy_pool import DecoyPool
 
-def generate_token():
-    return uuid.uuid4().hex
+def generate_token(conversation_id=None):
+    # Decoys are rendered before their conversation is known, so their tokens are unbound
+    return token_signing.issue("honeytoken", conversation_id)
+
+# Pre-rendered generic decoys for emails asking for a common kind of document
+decoys = DecoyPool(
+    generate_token,
+    lambda seed: pdf.get_client().fill_pdf(seed),
+    pdf_renderer.render,
+    depth=int(os.getenv('DECOY_POOL_DEPTH', '2'))
+)
+
+def start_decoy_pool():
+    decoys.start()
+
+def take_decoy(body):
+    return decoys.take(body)
 
 def generate_pdf_with_url(context, title, subtitle, section):
     pass
 
-def generate_pdf(body, title='Information', subtitle='info', section='info'):
-    token = generate_token()
-    path = pdf.generate_pdf(token, body, title, subtitle, section)
-    return token, path
+def generate_pdf(body, title='Information', subtitle='info', section='info', name=None, content=None,
+                 conversation_id=None, use_pool=True):
+    # Callers that already looked in the pool generate the PDF their reply was written for
+    if use_pool:
+        decoy = take_decoy(body)
+        if decoy is not None:
+            return decoy
+    token = generate_token(conversation_id)
+    filename, data = pdf.generate_pdf(token, body, title, subtitle, section, name, content, pdf_renderer.render)
+    return token, filename, data
 
 def generate_url():
     pass
\ No newline at end of file
@@ -0,0 +1,161 @@
+import queue
+import threading
+import time
+
+
+class InteractionWriter:
+    """
+    Write-behind ingestion of token hits for the tracking server.
+    Requests only put their hit on a bounded in-memory queue and return; a background
+    thread resolves the tokens and writes the interactions in batches, when `batch_size`
+    hits are pending or `flush_interval` seconds after the oldest pending hit.
+    Each conversation is written separately, so a conversation that cannot be written does
+    not hold back the others; its hits are retried with the next batch up to `max_attempts`
+    times, then dropped. Hits arriving while the queue is full are dropped and counted.
+    """
+
+    def __init__(self, resolve, write_batch, max_queue=10000, batch_size=100, flush_interval=1.0, max_attempts=3):
+        """
+        Initialize the writer and start its thread.
+        :param resolve: Function taking a token and returning (conversation_id, kind), or None if it is unknown.
+        :param write_batch: Function taking a list of
+                            (conversation_id, token_id, kind, ip_address, user_agent, timestamp) tuples,
+                            called with the interactions of one conversation at a time.
+        :param max_queue: The maximum number of hits waiting to be written.
+        :param batch_size: The number of hits written together.
+        :param flush_interval: The maximum number of seconds a hit waits before being written.
+        :param max_attempts: The number of times the hits of a conversation are written before they are dropped.
+        """
+        self.resolve = resolve
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, name="interaction-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, token_id, ip_address, user_agent, timestamp, match=None):
+        """
+        Queue a token hit without waiting for it to be written.
+        :param match: The (conversation_id, kind) of the token if it is already known,
+                      otherwise the token is resolved by the writer.
+        :return: True if the hit was queued, False if it was dropped because the queue is full.
+        """
+        try:
+            self.queue.put_nowait((token_id, ip_address, user_agent, timestamp, match, 0))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def run(self):
+        pending = []
+        oldest = None
+        while True:
+            timeout = self.flush_interval if oldest is None else max(0.0, oldest + self.flush_interval - time.monotonic())
+            try:
+                pending.append(self.queue.get(timeout=timeout))
+                oldest = oldest or time.monotonic()
+                # Take whatever else is already waiting, up to a full batch
+                while len(pending) < self.batch_size:
+                    pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if self.stopping.is_set():
+                break
+            if pending and (len(pending) >= self.batch_size or time.monotonic() >= oldest + self.flush_interval):
+                # Hits that failed are retried after another interval
+                pending = self.flush(pending)
+                oldest = time.monotonic() if pending else None
+            self.report_dropped()
+
+        # Shutting down: write everything still queued
+        while True:
+            try:
+                pending.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        pending = self.flush(pending) if pending else []
+        if pending:
+            print(f"Lost {len(pending)} interactions on shutdown.")
+        self.report_dropped()
+
+    def flush(self, hits):
+        """
+        Resolve and write a batch of hits, one conversation at a time.
+        :return: The hits that could not be resolved or written and are to be retried.
+        """
+        failed = []
+        by_conversation = {}
+        for hit in hits:
+            token_id, ip_address, user_agent, timestamp, match, _ = hit
+            if match is None:
+                try:
+                    match = self.resolve(token_id)
+                except Exception as error:
+                    print(f"An error occurred while resolving token {token_id}: {error}")
+                    failed.append(hit)
+                    continue
+            if match is None:
+                # Link scanners and guesses are not logged
+                print(f"Ignoring unknown token {token_id} from {ip_address}")
+                continue
+            conversation_id, kind = match
+            by_conversation.setdefault(conversation_id, []).append(
+                (hit, (conversation_id, token_id, kind, ip_address, user_agent, timestamp))
+            )
+
+        for conversation_id, group in by_conversation.items():
+            try:
+                self.write_batch([interaction for _, interaction in group])
+            except Exception as error:
+                print(f"An error occurred while writing {len(group)} interactions of conversation {conversation_id}: {error}")
+                failed.extend(hit for hit, _ in group)
+                continue
+            self.written += len(group)
+
+        retry = []
+        for hit in failed:
+            attempts = hit[5] + 1
+            if attempts < self.max_attempts:
+                retry.append(hit[:5] + (attempts,))
+            else:
+                with self.lock:
+                    self.failed += 1
+                print(f"Dropping the interaction of token {hit[0]} after {attempts} failed attempts.")
+        return retry
+
+    def report_dropped(self):
+        """Log how many hits were dropped since the last report."""
+        with self.lock:
+            dropped = self.dropped - self.reported_dropped
+            self.reported_dropped = self.dropped
+        if dropped:
+            print(f"Interaction queue full, dropped {dropped} hits ({self.reported_dropped} in total).")
+
+    def stats(self):
+        """
+        Get the ingestion counters.
+        :return: A dictionary with the numbers of queued and written hits, of hits dropped
+                 because the queue was full and of hits dropped because they could not be written.
+        """
+        with self.lock:
+            dropped, failed = self.dropped, self.failed
+        return {"queued": self.queue.qsize(), "written": self.written, "dropped": dropped, "failed": failed}
+
+    def stop(self, timeout=30):
+        """
+        Write the queued hits and stop the writer thread.
+        :param timeout: The maximum number of seconds to wait for the last writes.
+        """
+        self.stopping.set()
+        self.thread.join(timeout)
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+# Path of the SQLite database holding cached completions
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', '../logs/llm_cache.db')
+
+
+class LLMResponseCache:
+    """
+    A persistent cache of model completions, keyed on a hash of the prompt template,
+    the model and the normalized email body, so that scam campaigns sending the same
+    email to many addresses only pay for a few completions.
+    Each entry collects up to `variants` completions before it starts serving hits,
+    and hits pick one of them at random so repeated emails get different replies.
+    Entries expire after `ttl` seconds and the least recently used are evicted
+    beyond `max_entries`.
+    """
+
+    def __init__(self, db_path=LLM_CACHE_PATH, max_entries=5000, ttl=7 * 24 * 3600, variants=3):
+        """
+        Initialize the cache.
+        :param db_path: The path of the SQLite database file.
+        :param max_entries: The maximum number of cached emails.
+        :param ttl: The number of seconds an entry stays valid.
+        :param variants: The number of completions kept per entry.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, variants TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS idx_completions_last_access ON completions (last_access)")
+        self.connection.commit()
+
+    @staticmethod
+    def make_key(template, model, body):
+        """
+        Build the cache key of a request.
+        :param template: The text of the prompt template (including any request options).
+        :param model: The model name.
+        :param body: The email body; case and whitespace differences are ignored.
+        :return: The cache key.
+        """
+        normalized = re.sub(r'\s+', ' ', body.casefold()).strip()
+        return hashlib.sha256(f"{template}\x00{model}\x00{normalized}".encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Look up a completion.
+        :param key: The cache key.
+        :return: One of the cached completions, or None if the entry is missing,
+                 expired or still collecting variants.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT variants, created_at FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] > self.ttl:
+                self.connection.execute("DELETE FROM completions WHERE key = ?", (key,))
+                self.connection.commit()
+                row = None
+
+            variants = json.loads(row[0]) if row is not None else []
+            if len(variants) < self.variants:
+                self.misses += 1
+                return None
+
+            self.connection.execute("UPDATE completions SET last_access = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits += 1
+            return random.choice(variants)
+
+    def put(self, key, completion):
+        """
+        Add a completion to an entry, evicting the least recently used entries if the cache is full.
+        :param key: The cache key.
+        :param completion: The completion text.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT variants FROM completions WHERE key = ?", (key,)).fetchone()
+            variants = json.loads(row[0]) if row is not None else []
+            if len(variants) >= self.variants:
+                return
+            variants.append(completion)
+            self.connection.execute(
+                "INSERT INTO completions (key, variants, created_at, last_access) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET variants = excluded.variants, last_access = excluded.last_access",
+                (key, json.dumps(variants), now, now)
+            )
+            if row is None:
+                self.connection.execute(
+                    "DELETE FROM completions WHERE key IN ("
+                    "SELECT key FROM completions ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self.connection.commit()
+
+    def stats(self):
+        """
+        Get the cache statistics.
+        :return: A dictionary with the hit and miss counts, the hit rate and the number of entries.
+        """
+        with self.lock:
+            entries = self.connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+            }
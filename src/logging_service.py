@@ -2,7 +2,11 @@ import json
 import hashlib
 import os
 from datetime import datetime
-import uuid
+import conversation_store
+import token_signing
+
+# Conversation storage backend, selected with the LOG_BACKEND environment variable
+store = conversation_store.open_store()
 
 def get_conversation_id(sender):
     """
@@ -18,28 +22,23 @@ def get_conversation_id(sender):
 
 def create_new_conversation_log(sender):
     """
-    Create a new conversation log file.
+    Create a new conversation log.
     :param sender: The sender of the conversation.
     :return: The ID of the conversation.
     """
-    # Create a new conversation log json file with an unique id based on the sender's email
+    # Create a new conversation log with an unique id based on the sender's email
     conversation_id = get_conversation_id(sender)
-    conversation_log = {
-        "conversation_id": conversation_id,
-        "sender": sender,
-        "messages": []
-    }
-    if not os.path.exists("../logs"):
-        os.makedirs("../logs")
-
-    if os.path.exists(f"../logs/{conversation_id}.json"):
+    if not store.create_conversation(conversation_id, sender):
         print(f"Conversation log already exists for {conversation_id}")
-        return conversation_id
-
-    with open(f"../logs/{conversation_id}.json", "w") as file:
-        json.dump(conversation_log, file)
     return conversation_id
-    
+
+def has_conversation_log(conversation_id):
+    """
+    Check if a conversation log exists.
+    :param conversation_id: The ID of the conversation.
+    :return: True if the conversation exists, False otherwise.
+    """
+    return store.conversation_exists(conversation_id)
 
 def add_to_log(conversation_id, sender, message, timestamp):
     """
@@ -49,28 +48,23 @@ def add_to_log(conversation_id, sender, message, timestamp):
     :param message: The message content.
     :param timestamp: The timestamp of the message.
     """
-    # Add the message to the conversation log
-
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
+    # Append the message to the conversation log
+    store.append_message(conversation_id, sender, message, timestamp)
 
-        conversation_log["messages"].append({"from": sender, "message": message, "timestamp": timestamp})
-
-    with open(f"../logs/{conversation_id}.json", "w") as file:
-        json.dump(conversation_log, file)
-
-
-    
 def get_conversation_log(conversation_id):
     """
     Get the conversation log for a given conversation ID.
     :param conversation_id: The ID of the conversation.
-    :return: The conversation log.
+    :return: The conversation log, or None if it does not exist.
+    """
+    return store.get_conversation(conversation_id)
+
+def get_all_messages():
+    """
+    Iterate over the messages of every conversation.
+    :return: An iterator of (conversation_id, sender, message) tuples.
     """
-    # Get the conversation log for the given conversation ID
-    with open(f"/..conversation_logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-    return conversation_log
+    return store.iter_messages()
 
 def get_conversation_length(conversation_id):
     """
@@ -78,10 +72,7 @@ def get_conversation_length(conversation_id):
     :param conversation_id: The ID of the conversation.
     :return: The length of the conversation.
     """
-    # Get the length of the conversation
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-        return len(conversation_log["messages"])
+    return store.count_messages(conversation_id)
 
 def add_honeytoken_id(honeytoken_id, conversation_id):
     """
@@ -90,16 +81,11 @@ def add_honeytoken_id(honeytoken_id, conversation_id):
     :param conversation_id: The ID of the conversation.
     """
     # Add the honeytoken ID to the conversation
-    if not os.path.exists(f"../logs/{conversation_id}.json"):
+    if not store.conversation_exists(conversation_id):
         print(f"Conversation does not exist. for file {conversation_id}")
         return "Conversation does not exist."
     print(f"Adding honeytoken ID to conversation. {honeytoken_id} to {conversation_id}")
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-        conversation_log["honeytoken_id"] = honeytoken_id
-        conversation_log["interaction"] = []
-        with open(f"../logs/{conversation_id}.json", "w") as f:
-            json.dump(conversation_log, f)
+    store.set_token(conversation_id, "honeytoken", honeytoken_id)
     return "Honeytoken ID added to conversation."
 
 def get_honeytoken_id(conversation_id):
@@ -108,12 +94,7 @@ def get_honeytoken_id(conversation_id):
     :param conversation_id: The ID of the conversation.
     :return: The honeytoken ID.
     """
-    # Get the honeytoken ID associated with the conversation
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-        honeytoken_id = conversation_log.get("honeytoken_id")
-
-    return honeytoken_id
+    return store.get_token(conversation_id, "honeytoken")
 
 def has_honeytoken_id(conversation_id):
     """
@@ -121,10 +102,44 @@ def has_honeytoken_id(conversation_id):
     :param conversation_id: The ID of the conversation.
     :return: True if the conversation has a honeytoken ID, False otherwise.
     """
-    # Check if the conversation has a honeytoken ID
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-        return "honeytoken_id" in conversation_log
+    return get_honeytoken_id(conversation_id) is not None
+
+def lookup_token(token_id):
+    """
+    Find the conversation a honeytoken or signature token belongs to.
+    :param token_id: The token ID.
+    :return: A (conversation_id, kind) tuple, or None if the token is unknown.
+    """
+    return store.lookup_token(token_id)
+
+def rebuild_token_index():
+    """
+    Rebuild the token reverse index from the conversation logs.
+    :return: The number of tokens added to the index.
+    """
+    added = store.rebuild_token_index()
+    print(f"Token index rebuilt, {added} tokens added.")
+    return added
+
+def add_interaction(conversation_id, kind, token_id, ip_address, user_agent, timestamp):
+    """
+    Add an interaction to a conversation whose token was resolved already.
+    :param conversation_id: The ID of the conversation.
+    :param kind: The kind of token ("honeytoken" or "signature").
+    :param token_id: The token ID.
+    :param ip_address: The IP address of the interaction.
+    :param user_agent: The user agent of the interaction.
+    :param timestamp: The timestamp of the interaction.
+    """
+    store.add_interaction(conversation_id, token_id, kind, ip_address, user_agent, timestamp)
+    return f"Interaction added to {kind} log."
+
+def add_interactions(interactions):
+    """
+    Add a batch of interactions whose tokens were resolved already.
+    :param interactions: (conversation_id, token_id, kind, ip_address, user_agent, timestamp) tuples.
+    """
+    store.add_interactions(interactions)
 
 def add_token_interaction(token_id, ip_address, user_agent, timestamp):
     """
@@ -133,53 +148,35 @@ def add_token_interaction(token_id, ip_address, user_agent, timestamp):
     :param ip_address: The IP address of the interaction.
     :param user_agent: The user agent of the interaction.
     :param timestamp: The timestamp of the interaction.
+    :return: A status message, or None if the token is unknown.
     """
-    for file in os.listdir("../logs"):
-        with open(f"../logs/{file}", "r") as f:
-            conversation_log = json.load(f)
-            if conversation_log.get("honeytoken_id") == token_id:
-                conversation_log["interaction"].append({"ip_address": ip_address, "user_agent": user_agent, "timestamp": timestamp})
-                with open(f"../logs/{file}", "w") as f:
-                    json.dump(conversation_log, f)
-                return "Interaction added to honeytoken log."
-            if conversation_log.get("signature_id") == token_id:
-                conversation_log["interaction"].append({"ip_address": ip_address, "user_agent": user_agent, "timestamp": timestamp})
-                with open(f"../logs/{file}", "w") as f:
-                    json.dump(conversation_log, f)
-                return "Interaction added to signature log."
-            
+    match = lookup_token(token_id)
+    if match is None:
+        return None
+    conversation_id, kind = match
+    return add_interaction(conversation_id, kind, token_id, ip_address, user_agent, timestamp)
+
 def add_signature_id(conversation_id):
     """
-    Add a honeytoken ID to a conversation.
-    :param honeytoken_id: The honeytoken ID.
+    Add a signature ID to a conversation.
     :param conversation_id: The ID of the conversation.
     """
-    # Add the honeytoken ID to the conversation
-    if not os.path.exists(f"../logs/{conversation_id}.json"):
+    # Add the signature ID to the conversation
+    if not store.conversation_exists(conversation_id):
         print(f"Conversation does not exist. for file {conversation_id}")
         return "Conversation does not exist."
-    signature_id = uuid.uuid4().hex
+    signature_id = token_signing.issue("signature", conversation_id)
     print(f"Adding signature ID to conversation. {signature_id} to {conversation_id}")
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-        conversation_log["signature_id"] = signature_id
-        conversation_log["interactions"] = []
-        with open(f"../logs/{conversation_id}.json", "w") as f:
-            json.dump(conversation_log, f)
+    store.set_token(conversation_id, "signature", signature_id)
     return "Signature ID added to conversation."
 
 def get_signature_id(conversation_id):
     """
-    Get the honeytoken ID associated with a conversation.
+    Get the signature ID associated with a conversation.
     :param conversation_id: The ID of the conversation.
-    :return: The honeytoken ID.
+    :return: The signature ID.
     """
-    # Get the honeytoken ID associated with the conversation
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-        signature_id = conversation_log.get("signature_id")
-
-    return signature_id
+    return store.get_token(conversation_id, "signature")
 
 def has_signature_id(conversation_id):
     """
@@ -187,14 +184,20 @@ def has_signature_id(conversation_id):
     :param conversation_id: The ID of the conversation.
     :return: True if the conversation has a signature ID, False otherwise.
     """
-    # Check if the conversation has a signature ID
-    with open(f"../logs/{conversation_id}.json", "r") as file:
-        conversation_log = json.load(file)
-        return "signature_id" in conversation_log
+    return get_signature_id(conversation_id) is not None
             
-# Path for the queue file
+# Path for the queue file (snapshot of the queue at the last compaction)
 QUEUE_FILE_PATH = 'response_queue.json'
 
+# Path for the queue journal (enqueue and ack records since the last compaction)
+QUEUE_JOURNAL_PATH = 'response_queue.journal'
+
+# Number of journal records after which the queue is compacted into a new snapshot
+QUEUE_COMPACT_EVERY = int(os.getenv('QUEUE_COMPACT_EVERY', '100'))
+
+# Number of records currently in the journal
+queue_journal_records = 0
+
 def datetime_to_string(dt):
     """Convert a datetime object to a string for JSON serialization."""
     return dt.isoformat()
@@ -203,19 +206,84 @@ def string_to_datetime(dt_str):
     """Convert a string to a datetime object for JSON deserialization."""
     return datetime.fromisoformat(dt_str)
 
+def entry_to_dict(entry):
+    """Convert a queue entry to a JSON-serializable dictionary."""
+    return {**entry, "response_time": datetime_to_string(entry["response_time"])}
+
+def dict_to_entry(data):
+    """Convert a deserialized dictionary back to a queue entry."""
+    return {**data, "response_time": string_to_datetime(data["response_time"])}
+
+def fsync_directory(path):
+    """Flush a directory entry to disk so that a rename in it survives a crash."""
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def save_queue_to_file(queue):
-    """Save the response queue to a JSON file."""
-    with open(QUEUE_FILE_PATH, 'w') as file:
-        json.dump(
-            [{"email_id": entry["email_id"], "response_time": datetime_to_string(entry["response_time"])} for entry in queue],
-            file,
-            indent=4
-        )
+    """Atomically save the response queue to a JSON file (write, fsync, rename)."""
+    temp_path = QUEUE_FILE_PATH + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump([entry_to_dict(entry) for entry in queue], file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, QUEUE_FILE_PATH)
+    fsync_directory(QUEUE_FILE_PATH)
+
+def append_to_queue_journal(record):
+    """
+    Durably append a record to the queue journal.
+    :param record: {"op": "enqueue", "entry": entry} or {"op": "ack", "email_id": email_id}.
+    :return: The number of records in the journal.
+    """
+    global queue_journal_records
+    if record["op"] == "enqueue":
+        record = {"op": "enqueue", "entry": entry_to_dict(record["entry"])}
+    with open(QUEUE_JOURNAL_PATH, 'a') as file:
+        file.write(json.dumps(record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+    queue_journal_records += 1
+    return queue_journal_records
+
+def compact_queue(queue):
+    """
+    Write the queue as a new snapshot and empty the journal.
+    :param queue: All the entries of the queue.
+    """
+    global queue_journal_records
+    save_queue_to_file(queue)
+    # The journal is only emptied once the snapshot containing its records is durable
+    with open(QUEUE_JOURNAL_PATH, 'w') as file:
+        os.fsync(file.fileno())
+    queue_journal_records = 0
 
 def load_queue_from_file():
-    """Load the response queue from a JSON file."""
+    """Load the response queue from the last snapshot and replay the journal on top of it."""
+    global queue_journal_records
+    entries = {}
     if os.path.exists(QUEUE_FILE_PATH):
         with open(QUEUE_FILE_PATH, 'r') as file:
-            loaded_entries = json.load(file)
-            return [{"email_id": entry["email_id"], "response_time": string_to_datetime(entry["response_time"])} for entry in loaded_entries]
-    return []    
+            for entry in json.load(file):
+                entries[entry["email_id"]] = dict_to_entry(entry)
+
+    queue_journal_records = 0
+    if os.path.exists(QUEUE_JOURNAL_PATH):
+        with open(QUEUE_JOURNAL_PATH, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn record from a crash during an append
+                    print("Ignoring incomplete record at the end of the queue journal.")
+                    break
+                # Records replace by email ID, so replaying one twice is harmless
+                if record["op"] == "enqueue":
+                    entries[record["entry"]["email_id"]] = dict_to_entry(record["entry"])
+                elif record["op"] == "ack":
+                    entries.pop(record["email_id"], None)
+                queue_journal_records += 1
+
+    return sorted(entries.values(), key=lambda x: x["response_time"])
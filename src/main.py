@@ -1,14 +1,28 @@
+import os
 import time
 import threading
+from service_container import services
+
+# Fork the PDF render workers before any other module starts a thread
+services.pdf()
+
 from flask import Flask, request, jsonify
-import conversation_handler
-from gmail_service import GmailService
-from openai_service import OpenAIClient
-import logging_service as logs
-from datetime import datetime
+with services.timed("handlers"):
+    import conversation_handler
+    import honeytoken_service as honeytoken
+from reply_workers import ReplyWorkerPool
+
+# Load spaCy and the OpenAI client in the background while the threads start,
+# then report where the startup time went
+services.warm_up("nlp", "openai", report=True)
 
-# Initialize services
-gmail_service = GmailService()
+# Pool sending due replies concurrently, one at a time per conversation
+reply_pool = ReplyWorkerPool(
+    send=conversation_handler.send_response,
+    on_failure=conversation_handler.retry_email,
+    max_workers=int(os.getenv('REPLY_WORKERS', '4')),
+    job_timeout=int(os.getenv('REPLY_JOB_TIMEOUT', '600'))
+)
 
 # Shared variable to store the latest command to start a conversation
 command_data = {"start_conversation": None}
@@ -47,25 +61,39 @@ def monitor_emails():
     while True:
         print("Checking for new emails...")
         # Perform email monitoring tasks if needed
-        new_emails = gmail_service.check_for_new_emails()
+        new_emails = services.gmail().check_for_new_emails(
+            incremental=True, sender_filter=conversation_handler.has_conversation
+        )
         print(f"New emails: {len(new_emails)}")
+        quota = services.gmail().quota_stats()
+        print(f"Gmail quota: {quota['units_per_second']:.1f} of {quota['limit']:.0f} units per second used.")
+        cache = services.gmail().message_cache_stats()
+        print(f"Message cache: {cache['hit_rate']:.0%} hit rate, {cache['entries']} messages.")
+        ongoing = []
+        settled = []
         for email in new_emails:
             print(email['sender'])
             if conversation_handler.has_conversation(email['sender']):
                 print(f"Conversation with {email['sender']} already exists.")
-                # Process each new email if needed
-                conversation_handler.handle_incoming_message(email)
+                ongoing.append(email)
+            else:
+                settled.append(email['id'])
+        # Process the new emails together, so they are marked as read with one request
+        handled = conversation_handler.handle_incoming_messages(ongoing)
+        # Only now can the sync forget them; failed emails and a crash before this point return them again
+        services.gmail().acknowledge_emails(settled + handled)
 
         time.sleep(60)  # Adjust the frequency of the loop as needed
 
 def send_emails():
+    """Loop dispatching replies to the worker pool as soon as they are due."""
     while True:
-        queue = conversation_handler.get_queue()
-        if len(queue) > 0 and datetime.now() >= queue[0]['response_time']:
-            email = queue.pop(0)
-            conversation_handler.send_response(email['email_id'])
-    
-        time.sleep(60)  # Adjust the frequency of the loop as needed
+        # Sleeps until the next response time, or until a new email is queued
+        for email in conversation_handler.wait_for_due_emails():
+            reply_pool.submit(email)
+
+# Keep the pool of pre-rendered decoy PDFs filled in the background
+honeytoken.start_decoy_pool()
 
 # Start the monitoring loop in a separate thread
 monitor_thread = threading.Thread(target=monitor_emails)
@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Message formats, from least to most complete; a cached message serves requests for its format or less
+FORMAT_LEVELS = {"metadata": 0, "full": 1}
+
+
+def covers(cached, requested):
+    """
+    Check if a cached (format, headers) pair holds everything a request needs; metadata
+    messages only hold the headers they were fetched with.
+    """
+    if cached[0] != requested[0]:
+        return FORMAT_LEVELS[cached[0]] > FORMAT_LEVELS[requested[0]]
+    return cached[0] == "full" or set(requested[1]) <= set(cached[1])
+
+
+class MessageCache:
+    """
+    A bounded LRU cache of parsed Gmail messages keyed by message ID, so that a message
+    seen by one read path is not fetched and decoded again by the next. Entries expire
+    after `ttl` seconds and are invalidated when the labels of the message change.
+    Cached messages are shared and must not be modified by callers.
+    """
+
+    def __init__(self, max_entries=1000, ttl=600):
+        """
+        Initialize the cache.
+        :param max_entries: The maximum number of cached messages.
+        :param ttl: The number of seconds a message stays valid.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, msg_id, msg_format="full", metadata_headers=None):
+        """
+        Look up a message.
+        :param msg_id: The message ID.
+        :param msg_format: The format needed, "full" or "metadata".
+        :param metadata_headers: The headers needed with the "metadata" format.
+        :return: The message, or None if it is missing, expired or cached in a less complete format.
+        """
+        with self.lock:
+            entry = self.entries.get(msg_id)
+            if entry is not None and time.monotonic() - entry[2] > self.ttl:
+                del self.entries[msg_id]
+                entry = None
+            if entry is None or not covers(entry[0], (msg_format, metadata_headers or ())):
+                self.misses += 1
+                return None
+            self.entries.move_to_end(msg_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, msg_id, message, msg_format="full", metadata_headers=None):
+        """
+        Cache a message, evicting the least recently used ones if the cache is full.
+        A message is not replaced by a less complete format of itself.
+        """
+        cached_format = (msg_format, tuple(metadata_headers or ()))
+        with self.lock:
+            entry = self.entries.get(msg_id)
+            if entry is not None and FORMAT_LEVELS[entry[0][0]] > FORMAT_LEVELS[msg_format]:
+                return
+            self.entries[msg_id] = (cached_format, message, time.monotonic())
+            self.entries.move_to_end(msg_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def update_labels(self, msg_ids, added=(), removed=()):
+        """
+        Apply a label change made by this client to the cached copies of messages.
+        :param msg_ids: The message IDs.
+        :param added: The label IDs added.
+        :param removed: The label IDs removed.
+        """
+        with self.lock:
+            for msg_id in msg_ids:
+                entry = self.entries.get(msg_id)
+                if entry is None:
+                    continue
+                labels = [label for label in entry[1].get('labelIds', []) if label not in removed]
+                labels += [label for label in added if label not in labels]
+                # Cached messages are shared, so the updated one is a copy
+                self.entries[msg_id] = (entry[0], dict(entry[1], labelIds=labels), entry[2])
+
+    def label_changed(self, msg_id, added=(), removed=()):
+        """
+        Handle a label change seen through the mailbox history: the message is dropped
+        unless its cached labels already reflect the change, as for changes made by this client.
+        :param msg_id: The message ID.
+        :param added: The label IDs added.
+        :param removed: The label IDs removed.
+        """
+        with self.lock:
+            entry = self.entries.get(msg_id)
+            if entry is None:
+                return
+            labels = entry[1].get('labelIds', [])
+            if any(label not in labels for label in added) or any(label in labels for label in removed):
+                del self.entries[msg_id]
+                self.invalidations += 1
+
+    def invalidate(self, msg_ids):
+        """
+        Drop messages whose labels changed or that were deleted.
+        :param msg_ids: The message IDs.
+        """
+        with self.lock:
+            for msg_id in msg_ids:
+                if self.entries.pop(msg_id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drop every cached message."""
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Get the cache statistics.
+        :return: A dictionary with the hit and miss counts, the hit rate, the number of
+                 invalidated messages and the number of entries.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "entries": len(self.entries),
+            }
@@ -1,12 +1,49 @@
+import os
+import random
+import re
+import threading
 import spacy
 
+# Only the first characters of an email are analyzed
+MAX_CHARS = int(os.getenv('NLP_MAX_CHARS', '5000'))
+
+# Share of the emails decided by the lexical fast path that are also run through
+# spaCy, to measure how often both agree
+AUDIT_RATE = float(os.getenv('NLP_AUDIT_RATE', '0.05'))
+
+# Irregular forms of the keywords, which the regular inflections do not cover
+IRREGULAR_FORMS = {"send": ["sent"], "deal": ["dealt"]}
+
+def inflections(word):
+    """
+    List the surface forms a keyword can take in an email.
+
+    Args:
+        word (str): The keyword.
+
+    Returns:
+        set of str: The keyword, its regular plural and verb inflections and its irregular forms.
+    """
+    forms = {word, word + "s", word + "es", word + "ed", word + "ing"}
+    if word.endswith("e"):
+        forms.update({word + "d", word[:-1] + "ing"})
+    forms.update(IRREGULAR_FORMS.get(word, []))
+    return forms
+
 class PDFTriggerDetector:
-    def __init__(self):
+    def __init__(self, max_chars=MAX_CHARS, fast_path=True, audit_rate=AUDIT_RATE):
         """
         Initialize the NLP model and keywords for detecting PDF triggers.
+
+        Args:
+            max_chars (int): The number of characters of each email that are analyzed.
+            fast_path (bool): Whether emails are first checked with the lexical matcher.
+            audit_rate (float): The share of fast path decisions also checked with spaCy.
         """
-        # Load spaCy's English NLP model
-        self.nlp = spacy.load("en_core_web_sm")
+        # Load spaCy's English NLP model, without the parser and entity recognizer:
+        # lemmas only need the tagger, the attribute ruler and the lemmatizer
+        self.nlp = spacy.load("en_core_web_sm", exclude=["parser", "ner"])
+        self.max_chars = max_chars
         
         # Define base keywords and their synonyms
         self.base_keywords = {
@@ -20,6 +57,20 @@ class PDFTriggerDetector:
         self.expanded_keywords = self.expand_keywords(self.base_keywords)
         print("Expanded keywords:", self.expanded_keywords)
 
+        # Lexical fast path: a word that is one of the surface forms of a keyword is a
+        # trigger, and an email without any word starting with one is not. Other words
+        # starting with a surface form (e.g. "doctor", "delivery") are left to spaCy.
+        self.fast_path = fast_path
+        self.audit_rate = audit_rate
+        self.surface_forms = set()
+        for keyword in self.expanded_keywords:
+            self.surface_forms.update(inflections(keyword))
+        alternatives = sorted(self.surface_forms, key=len, reverse=True)
+        self.surface_pattern = re.compile(r'\b(?:' + '|'.join(map(re.escape, alternatives)) + r')[a-z]*')
+
+        self.stats_lock = threading.Lock()
+        self.counts = {"fast": 0, "model": 0, "audited": 0, "agreed": 0}
+
     def expand_keywords(self, base_keywords):
         """
         Expand the base keywords with synonyms using spaCy's semantic similarity.
@@ -31,6 +82,70 @@ class PDFTriggerDetector:
             expanded.update(synonyms)
         return expanded
 
+    def prepare_text(self, email_body):
+        """
+        Lowercase an email body and cut it to the analyzed length.
+        """
+        return email_body[:self.max_chars].lower()
+
+    def fast_check(self, text):
+        """
+        Decide whether a prepared email asks for a document without running spaCy.
+
+        Args:
+            text (str): The lowercased email body.
+
+        Returns:
+            bool or None: The decision, or None if spaCy is needed to decide.
+        """
+        ambiguous = False
+        for match in self.surface_pattern.finditer(text):
+            if match.group(0) in self.surface_forms:
+                return True
+            ambiguous = True
+        return None if ambiguous else False
+
+    def record(self, fast_decision, model_decision):
+        """
+        Count a decision, and whether both stages agreed when an email went through both.
+        """
+        with self.stats_lock:
+            if fast_decision is None:
+                self.counts["model"] += 1
+                return
+            self.counts["fast"] += 1
+            if model_decision is not None:
+                self.counts["audited"] += 1
+                self.counts["agreed"] += fast_decision == model_decision
+        if model_decision is not None and fast_decision != model_decision:
+            print(f"Fast path decided {fast_decision} where spaCy decided {model_decision}.")
+
+    def stats(self):
+        """
+        Get the decision statistics.
+
+        Returns:
+            dict: The numbers of emails decided by the fast path and by spaCy, the number of
+            fast path decisions checked with spaCy and the rate at which both agreed.
+        """
+        with self.stats_lock:
+            stats = dict(self.counts)
+        stats["agreement_rate"] = stats["agreed"] / stats["audited"] if stats["audited"] else None
+        return stats
+
+    def needs_model(self, fast_decision):
+        """
+        Check if an email goes through spaCy, either because the fast path could not decide
+        or because the decision was picked for an audit.
+        """
+        return fast_decision is None or random.random() < self.audit_rate
+
+    def has_trigger(self, doc):
+        """
+        Check if any token of a processed email matches the expanded keyword set.
+        """
+        return any(token.lemma_ in self.expanded_keywords for token in doc)
+
     def analyze_email(self, email_body):
         """
         Analyze the email body to determine if a PDF should be sent.
@@ -41,11 +156,42 @@ class PDFTriggerDetector:
         Returns:
             bool: True if the PDF should be sent, False otherwise.
         """
-        doc = self.nlp(email_body.lower())
+        text = self.prepare_text(email_body)
+        if not self.fast_path:
+            return self.has_trigger(self.nlp(text))
+
+        fast_decision = self.fast_check(text)
+        model_decision = self.has_trigger(self.nlp(text)) if self.needs_model(fast_decision) else None
+        self.record(fast_decision, model_decision)
+        return fast_decision if model_decision is None else model_decision
+
+    def analyze_many(self, email_bodies, batch_size=32, n_process=1):
+        """
+        Analyze several email bodies in one pass through the model.
+
+        Args:
+            email_bodies (iterable of str): The text contents of the emails.
+            batch_size (int): The number of emails processed together.
+            n_process (int): The number of processes used, -1 for one per CPU.
+
+        Returns:
+            list of bool: For each email, True if the PDF should be sent, False otherwise.
+        """
+        texts = [self.prepare_text(body) for body in email_bodies]
+        if not self.fast_path:
+            docs = self.nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+            return [self.has_trigger(doc) for doc in docs]
 
-        # Check if any token matches the expanded keyword set
-        for token in doc:
-            if token.lemma_ in self.expanded_keywords:
-                return True  # Trigger PDF sending if a match is found
+        fast_decisions = [self.fast_check(text) for text in texts]
+        # Only the emails the fast path left open, or picked for an audit, go through spaCy
+        model_indexes = [index for index, decision in enumerate(fast_decisions) if self.needs_model(decision)]
+        docs = self.nlp.pipe((texts[index] for index in model_indexes), batch_size=batch_size, n_process=n_process)
+        model_decisions = [None] * len(texts)
+        for index, doc in zip(model_indexes, docs):
+            model_decisions[index] = self.has_trigger(doc)
 
-        return False  # No match found
+        results = []
+        for fast_decision, model_decision in zip(fast_decisions, model_decisions):
+            self.record(fast_decision, model_decision)
+            results.append(fast_decision if model_decision is None else model_decision)
+        return results
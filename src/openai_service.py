@@ -1,12 +1,56 @@
 import os
+import re
+import json
+import time
+import random
+import asyncio
+import httpx
 import openai
 from dotenv import load_dotenv
+from rate_limiter import TokenBucket
+from llm_cache import LLMResponseCache
+
+# Model used for every completion
+MODEL = "gpt-4o"
+
+# Prompts sent before the email text, by method
+PROMPTS = {
+    "answer_email": 'Your persona is James Dawson. Answer the following scam email by outputting only the body text and not the subject. If possible answer in the language the email is in. Keep it short. Please go along with the scam and try to keep the conversation going. Do not give any personal information or banking details. The output will not be altered and has to be a finished piece of text: \n',
+    "answer_email_with_pdf": 'Your persona is James Dawson. Answer the following email by outputting only the body text and not the subject. If possible answer in the language the email is in. Keep it short. The output will not be altered and has to be a finished piece of text. The answer will include a pdf file containing information relevant to the email being answered: \n',
+    "fill_pdf": 'Based on the following email, please output text that is relevant in order to fill a pdf file to be sent, and output only the text. Please leave no spaces to be filled. The output will not be altered and has to be a finished piece of text: \n',
+    "generate_pdf_name": 'Based on the following email come up with a name for a PDF file, without the .pdf extension, please only output the name: \n',
+    "generate_pdf_reply": 'Your persona is James Dawson. Answer the following email, which will be sent with a pdf file containing information relevant to the email being answered. In "reply" output only the body text of the answer and not the subject. If possible answer in the language the email is in. Keep it short. In "pdf_name" output a name for the PDF file, without the .pdf extension. In "pdf_content" output text that is relevant in order to fill the pdf file, leaving no spaces to be filled. The outputs will not be altered and have to be finished pieces of text: \n',
+}
+
+# JSON schema of the combined reply, PDF name and PDF content response
+PDF_REPLY_SCHEMA = {
+    "name": "pdf_reply",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "reply": {"type": "string"},
+            "pdf_name": {"type": "string"},
+            "pdf_content": {"type": "string"},
+        },
+        "required": ["reply", "pdf_name", "pdf_content"],
+        "additionalProperties": False,
+    },
+}
+
+# Errors worth retrying: rate limits (429), server errors (5xx), timeouts and connection errors
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+# Rough number of completion tokens reserved per request before the real usage is known
+ESTIMATED_COMPLETION_TOKENS = 500
 
 class OpenAIClient:
     def __init__(self):
         """
         Initialize the OpenAI Client.
         Dynamically load the API key from .env for local testing or Docker secrets.
+        The sync and async clients each share one HTTP connection pool, whose size
+        also bounds the number of concurrent requests.
         """
         env_file_path = os.getenv('ENV_PATH', '.env')  # Default to .env for local testing
         if os.path.exists(env_file_path):
@@ -20,66 +64,269 @@ class OpenAIClient:
 
         openai.api_key = self.api_key
 
+        self.timeout = float(os.getenv('OPENAI_TIMEOUT', '60'))
+        self.max_retries = int(os.getenv('OPENAI_MAX_RETRIES', '5'))
+        self.max_backoff = float(os.getenv('OPENAI_MAX_BACKOFF', '60'))
+        max_concurrency = int(os.getenv('OPENAI_MAX_CONCURRENCY', '8'))
+
+        # Requests wait for a free connection, so the pool limits concurrency
+        limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+        timeout = httpx.Timeout(self.timeout, pool=None)
+        self.client = openai.OpenAI(
+            api_key=self.api_key, max_retries=0, timeout=timeout,
+            http_client=httpx.Client(limits=limits, timeout=timeout)
+        )
+        self.async_client = openai.AsyncOpenAI(
+            api_key=self.api_key, max_retries=0, timeout=timeout,
+            http_client=httpx.AsyncClient(limits=limits, timeout=timeout)
+        )
+
+        # Requests and tokens per minute allowed by the account tier
+        requests_per_minute = int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '500'))
+        tokens_per_minute = int(os.getenv('OPENAI_TOKENS_PER_MINUTE', '30000'))
+        self.request_limiter = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.token_limiter = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+
+        # Completions shared by duplicate emails
+        self.cache = LLMResponseCache(
+            max_entries=int(os.getenv('LLM_CACHE_MAX_ENTRIES', '5000')),
+            ttl=int(os.getenv('LLM_CACHE_TTL_HOURS', '168')) * 3600,
+            variants=int(os.getenv('LLM_CACHE_VARIANTS', '3'))
+        )
+
+    def estimate_tokens(self, prompt):
+        """Estimate the tokens a request uses, at about four characters per token."""
+        return len(prompt) // 4 + ESTIMATED_COMPLETION_TOKENS
+
+    def settle_tokens(self, estimate, response):
+        """
+        Charge the token limiter the tokens a request really used instead of its estimate,
+        so long completions count in full against the tokens per minute.
+        """
+        usage = getattr(response, 'usage', None)
+        if usage is not None and usage.total_tokens is not None:
+            self.token_limiter.adjust(usage.total_tokens - estimate)
+
+    def retry_delay(self, attempt, error):
+        """
+        Get the delay before retrying a failed request: exponential backoff with
+        full jitter, but never shorter than a Retry-After sent by the API.
+        """
+        delay = random.uniform(0, min(self.max_backoff, 2 ** attempt))
+        if isinstance(error, openai.APIStatusError):
+            retry_after = error.response.headers.get('retry-after')
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    def complete(self, prompt, **kwargs):
+        """
+        Send a prompt to the OpenAI API, retrying rate limits and server errors.
+        :param prompt: The full prompt text.
+        :return: The response text from the model, or None if the request failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.request_limiter.acquire()
+            estimate = self.estimate_tokens(prompt)
+            self.token_limiter.acquire(estimate)
+            try:
+                response = self.client.chat.completions.create(
+                    model=MODEL, messages=[{"role": "user", "content": prompt}], **kwargs
+                )
+                self.settle_tokens(estimate, response)
+                return response.choices[0].message.content.strip()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    print(f"An error occurred: {e}")
+                    return None
+                delay = self.retry_delay(attempt, e)
+                print(f"OpenAI request failed ({e}), retrying in {delay:.1f} seconds.")
+                time.sleep(delay)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                return None
+
+    async def complete_async(self, prompt, **kwargs):
+        """
+        Async version of complete.
+        :param prompt: The full prompt text.
+        :return: The response text from the model, or None if the request failed.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.request_limiter.acquire_async()
+            estimate = self.estimate_tokens(prompt)
+            await self.token_limiter.acquire_async(estimate)
+            try:
+                response = await self.async_client.chat.completions.create(
+                    model=MODEL, messages=[{"role": "user", "content": prompt}], **kwargs
+                )
+                self.settle_tokens(estimate, response)
+                return response.choices[0].message.content.strip()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    print(f"An error occurred: {e}")
+                    return None
+                delay = self.retry_delay(attempt, e)
+                print(f"OpenAI request failed ({e}), retrying in {delay:.1f} seconds.")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                return None
+
+    def cache_key(self, template, email, kwargs):
+        """
+        Build the cache key of a request from the text of its prompt template, options and email,
+        so that editing a prompt in PROMPTS stops serving the completions of the old one.
+        """
+        return self.cache.make_key(PROMPTS[template] + json.dumps(kwargs, sort_keys=True), MODEL, email)
+
+    def cached_complete(self, template, email, validate=None, **kwargs):
+        """
+        Complete a prompt template for an email, serving duplicate emails from the cache.
+        :param template: The key of the prompt in PROMPTS.
+        :param email: The email text.
+        :param validate: Optional function returning False for completions that must not be cached.
+        :return: The response text from the model, or None if the request failed.
+        """
+        key = self.cache_key(template, email, kwargs)
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+        response = self.complete(PROMPTS[template] + email, **kwargs)
+        if response is not None and (validate is None or validate(response)):
+            self.cache.put(key, response)
+        return response
+
+    async def cached_complete_async(self, template, email, validate=None, **kwargs):
+        """Async version of cached_complete."""
+        key = self.cache_key(template, email, kwargs)
+        response = self.cache.get(key)
+        if response is not None:
+            return response
+        response = await self.complete_async(PROMPTS[template] + email, **kwargs)
+        if response is not None and (validate is None or validate(response)):
+            self.cache.put(key, response)
+        return response
+
+    def cache_stats(self):
+        """
+        Get the completion cache statistics.
+        :return: A dictionary with the hit and miss counts, the hit rate and the number of entries.
+        """
+        return self.cache.stats()
+
     def answer_email(self, email):
         """
-        Send a prompt to the OpenAI API and get the response.
-        :param prompt: The prompt text to send.
+        Generate a reply to a scam email.
+        :param email: The email text.
         :return: The response text from the model.
         """
-        try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": 'Your persona is James Dawson. Answer the following scam email by outputting only the body text and not the subject. If possible answer in the language the email is in. Keep it short. Please go along with the scam and try to keep the conversation going. Do not give any personal information or banking details. The output will not be altered and has to be a finished piece of text: \n' + email}]
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return None
-        
+        return self.cached_complete("answer_email", email)
+
     def answer_email_with_pdf(self, email):
         """
-        Send a prompt to the OpenAI API and get the response.
-        :param email: The prompt text to send.
+        Generate a reply to an email that will be sent with a PDF attachment.
+        :param email: The email text.
         :return: The response text from the model.
         """
-        try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": 'Your persona is James Dawson. Answer the following email by outputting only the body text and not the subject. If possible answer in the language the email is in. Keep it short. The output will not be altered and has to be a finished piece of text. The answer will include a pdf file containing information relevant to the email being answered: \n' + email}]
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return None
+        return self.cached_complete("answer_email_with_pdf", email)
 
     def fill_pdf(self, email):
         """
-        Send a prompt to the OpenAI API and get the response.
-        :param email: The email text to send.
+        Generate the text content of a PDF file relevant to an email.
+        :param email: The email text.
         :return: The response text from the model.
         """
-        try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": 'Based on the following email, please output text that is relevant in order to fill a pdf file to be sent, and output only the text. Please leave no spaces to be filled. The output will not be altered and has to be a finished piece of text: \n' + email}],
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return None
-        
+        return self.cached_complete("fill_pdf", email)
+
     def generate_pdf_name(self, email):
         """
-        Send a prompt to the OpenAI API and get the response.
-        :param prompt: The prompt text to send.
+        Generate a PDF file name (without extension) relevant to an email.
+        :param email: The email text.
         :return: The response text from the model.
         """
+        return self.cached_complete("generate_pdf_name", email)
+
+    def parse_pdf_reply(self, text):
+        """
+        Parse and validate a combined PDF reply response.
+        :param text: The JSON text returned by the model.
+        :return: A dictionary with "reply", "pdf_name" and "pdf_content", or None if it is invalid.
+        """
         try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": 'Based on the following email come up with a name for a PDF file, without the .pdf extension, please only output the name: \n' + email}],
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return None
\ No newline at end of file
+            data = json.loads(text)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(data, dict):
+            return None
+        fields = {key: data.get(key) for key in ("reply", "pdf_name", "pdf_content")}
+        if not all(isinstance(value, str) and value.strip() for value in fields.values()):
+            return None
+
+        # The name becomes a file name, so drop the extension and any path separators
+        name = re.sub(r'\.pdf$', '', fields["pdf_name"].strip(), flags=re.IGNORECASE)
+        name = re.sub(r'[\\/:*?"<>|]', '', name).strip()
+        return {"reply": fields["reply"].strip(), "pdf_name": name or None, "pdf_content": fields["pdf_content"].strip()}
+
+    def generate_pdf_reply(self, email):
+        """
+        Generate the reply to an email together with the name and content of the PDF
+        sent with it, in one structured request. Falls back to answer_email_with_pdf,
+        generate_pdf_name and fill_pdf if the structured response is unusable.
+        :param email: The email text.
+        :return: A dictionary with "reply", "pdf_name" (may be None) and "pdf_content",
+                 or None if no reply or content could be generated.
+        """
+        result = self.parse_pdf_reply(self.cached_complete(
+            "generate_pdf_reply", email, validate=lambda text: self.parse_pdf_reply(text) is not None,
+            response_format={"type": "json_schema", "json_schema": PDF_REPLY_SCHEMA}
+        ))
+        if result is not None:
+            return result
+
+        print("Structured PDF reply unusable, falling back to separate requests.")
+        result = {
+            "reply": self.answer_email_with_pdf(email),
+            "pdf_name": self.generate_pdf_name(email),
+            "pdf_content": self.fill_pdf(email),
+        }
+        if result["reply"] is None or result["pdf_content"] is None:
+            return None
+        return result
+
+    async def generate_pdf_reply_async(self, email):
+        """Async version of generate_pdf_reply."""
+        result = self.parse_pdf_reply(await self.cached_complete_async(
+            "generate_pdf_reply", email, validate=lambda text: self.parse_pdf_reply(text) is not None,
+            response_format={"type": "json_schema", "json_schema": PDF_REPLY_SCHEMA}
+        ))
+        if result is not None:
+            return result
+
+        print("Structured PDF reply unusable, falling back to separate requests.")
+        reply, name, content = await asyncio.gather(
+            self.answer_email_with_pdf_async(email),
+            self.generate_pdf_name_async(email),
+            self.fill_pdf_async(email)
+        )
+        if reply is None or content is None:
+            return None
+        return {"reply": reply, "pdf_name": name, "pdf_content": content}
+
+    async def answer_email_async(self, email):
+        """Async version of answer_email."""
+        return await self.cached_complete_async("answer_email", email)
+
+    async def answer_email_with_pdf_async(self, email):
+        """Async version of answer_email_with_pdf."""
+        return await self.cached_complete_async("answer_email_with_pdf", email)
+
+    async def fill_pdf_async(self, email):
+        """Async version of fill_pdf."""
+        return await self.cached_complete_async("fill_pdf", email)
+
+    async def generate_pdf_name_async(self, email):
+        """Async version of generate_pdf_name."""
+        return await self.cached_complete_async("generate_pdf_name", email)
@@ -0,0 +1,90 @@
+import os
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from reportlab.pdfbase.pdfmetrics import stringWidth
+import generatePDF
+
+# Fonts used by generatePDF.insert_text, loaded by each worker at startup
+FONTS = ["Helvetica", "Helvetica-Bold", "Helvetica-Oblique"]
+
+
+def init_worker(template_path):
+    """Load the template and the font metrics once per worker process."""
+    generatePDF.load_template(template_path)
+    for font in FONTS:
+        stringWidth("warm-up", font, 12)
+
+
+class PDFRenderService:
+    """
+    Render honeytoken PDFs on a pool of worker processes, so that reportlab layout
+    and pikepdf processing use several cores and stay off the mail and Flask threads.
+    """
+
+    def __init__(self, max_workers=2, max_pending=16, timeout=60):
+        """
+        Initialize the service and start the worker processes.
+        :param max_workers: The number of worker processes.
+        :param max_pending: The maximum number of jobs queued or running at the same time.
+        :param timeout: The number of seconds to wait for a free slot and for each job.
+        """
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        # Workers are forked, so the service is started before the other threads of the process
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_worker,
+            initargs=(generatePDF.TEMPLATE_PATH,)
+        )
+        # Submitting a first job launches all the worker processes now
+        self.executor.submit(generatePDF.load_template, generatePDF.TEMPLATE_PATH).result()
+
+    def submit(self, token, content, title, subtitle, section):
+        """
+        Queue a PDF for rendering.
+        :return: A Future resolving to the PDF bytes.
+        :raises TimeoutError: If the job queue stays full for longer than the timeout.
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError("PDF render queue is full.")
+        try:
+            future = self.executor.submit(generatePDF.render_pdf, token, content, title, subtitle, section)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def render(self, token, content, title, subtitle, section, timeout=None):
+        """
+        Render a PDF and wait for it.
+        :return: The PDF bytes.
+        :raises TimeoutError: If the job does not finish within the timeout.
+        """
+        future = self.submit(token, content, title, subtitle, section)
+        return future.result(timeout=timeout or self.timeout)
+
+
+# The process-wide render service, or None to render in the calling thread
+service = None
+
+
+def start():
+    """Start the process-wide render service, configured from the environment."""
+    global service
+    if service is None:
+        service = PDFRenderService(
+            max_workers=int(os.getenv('PDF_RENDER_WORKERS', str(min(4, os.cpu_count() or 1)))),
+            max_pending=int(os.getenv('PDF_RENDER_QUEUE', '16')),
+            timeout=int(os.getenv('PDF_RENDER_TIMEOUT', '60'))
+        )
+    return service
+
+
+def render(token, content, title, subtitle, section):
+    """Render a PDF on the render service if it was started, otherwise in the calling thread."""
+    if service is None:
+        return generatePDF.render_pdf(token, content, title, subtitle, section)
+    return service.render(token, content, title, subtitle, section)
@@ -0,0 +1,80 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket refilled continuously at a fixed rate.
+    Callers reserve tokens and wait until the reservation is covered, so waiting
+    callers are served in the order they arrived.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        Initialize the bucket, starting full.
+        :param rate: The number of tokens added per second.
+        :param capacity: The maximum number of tokens the bucket holds.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take tokens from the bucket, going into debt if there are not enough.
+        :param amount: The number of tokens to take (capped at the capacity).
+        :return: The number of seconds to wait before the reservation is covered.
+        """
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def try_acquire(self, amount):
+        """
+        Take tokens from the bucket only if there are enough, without going into debt.
+        :param amount: The number of tokens to take, at most the capacity.
+        :return: 0 if the tokens were taken, otherwise the number of seconds until there are enough.
+        :raises ValueError: If the amount is larger than the bucket can ever hold.
+        """
+        if amount > self.capacity:
+            raise ValueError(f"Cannot take {amount} tokens from a bucket holding at most {self.capacity}.")
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def adjust(self, delta):
+        """
+        Correct an earlier reservation once its real cost is known, taking the extra tokens
+        (going into debt if needed) or giving back the unused ones.
+        :param delta: The real cost minus the reserved amount.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate - delta)
+            self.updated = now
+
+    def acquire(self, amount=1):
+        """Block until the requested tokens are available."""
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self, amount=1):
+        """Wait without blocking the event loop until the requested tokens are available."""
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
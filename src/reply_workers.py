@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReplyWorkerPool:
+    """
+    Send due replies concurrently on a bounded pool of threads, with at most
+    one reply in flight per conversation.
+    """
+
+    def __init__(self, send, on_failure, max_workers=4, job_timeout=600):
+        """
+        Initialize the worker pool.
+        :param send: Function taking a queue entry and a time.monotonic() deadline,
+                     returning True if the reply was sent.
+        :param on_failure: Function called with the queue entry when the reply was not sent.
+        :param max_workers: The maximum number of replies being sent at the same time.
+        :param job_timeout: The number of seconds a reply may take before it is abandoned.
+        """
+        self.send = send
+        self.on_failure = on_failure
+        self.job_timeout = job_timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="reply-worker")
+        self.lock = threading.Lock()
+
+        # Conversations with a reply in flight, and the replies waiting behind them
+        self.busy = set()
+        self.waiting = {}
+
+    @staticmethod
+    def conversation_key(entry):
+        """Entries queued before conversation IDs were recorded are their own conversation."""
+        return entry.get("conversation_id") or entry["email_id"]
+
+    def submit(self, entry):
+        """
+        Schedule a due reply. It starts right away unless its conversation already
+        has a reply in flight, in which case it runs after that one.
+        :param entry: The queue entry to send.
+        """
+        key = self.conversation_key(entry)
+        with self.lock:
+            if key in self.busy:
+                self.waiting.setdefault(key, deque()).append(entry)
+                return
+            self.busy.add(key)
+        self.executor.submit(self._run, key, entry)
+
+    def _run(self, key, entry):
+        deadline = time.monotonic() + self.job_timeout
+        watchdog = threading.Timer(
+            self.job_timeout,
+            lambda: print(f"Reply to {entry['email_id']} has been running for over {self.job_timeout} seconds.")
+        )
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            sent = self.send(entry, deadline)
+        except Exception as error:
+            print(f"An error occurred while sending the reply to {entry['email_id']}: {error}")
+            sent = False
+        finally:
+            watchdog.cancel()
+
+        if not sent:
+            self.on_failure(entry)
+
+        with self.lock:
+            waiting = self.waiting.get(key)
+            if waiting:
+                next_entry = waiting.popleft()
+                if not waiting:
+                    del self.waiting[key]
+            else:
+                self.busy.discard(key)
+                return
+        self.executor.submit(self._run, key, next_entry)
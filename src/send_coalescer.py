@@ -0,0 +1,56 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class SendCoalescer:
+    """
+    Coalesce requests made by concurrent threads into batches. Each caller gets a Future,
+    and a background thread gathers the requests arriving within `window` seconds of the
+    first one (up to `max_batch`) and hands them to `send_batch` together.
+    """
+
+    def __init__(self, send_batch, max_batch=20, window=0.2):
+        """
+        Initialize the coalescer and start its thread.
+        :param send_batch: Function taking a list of requests and returning, in the same order,
+                           a (result, exception) tuple for each of them.
+        :param max_batch: The maximum number of requests per batch.
+        :param window: The number of seconds to wait for more requests after the first one.
+        """
+        self.send_batch = send_batch
+        self.max_batch = max_batch
+        self.window = window
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="send-coalescer", daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        """
+        Queue a request for the next batch.
+        :return: A Future resolving to the result of the request.
+        """
+        future = Future()
+        self.queue.put((request, future))
+        return future
+
+    def run(self):
+        while True:
+            pending = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            try:
+                while len(pending) < self.max_batch:
+                    pending.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                pass
+
+            try:
+                outcomes = self.send_batch([request for request, _ in pending])
+            except Exception as error:
+                outcomes = [(None, error)] * len(pending)
+            for (_, future), (result, exception) in zip(pending, outcomes):
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
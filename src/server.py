@@ -1,9 +1,35 @@
+import dotenv
+
+# Loaded before anything reads the configuration; the signing keys must match the mail server's
+dotenv.load_dotenv()
+
 from flask import Flask, request, redirect
 import logging_service as logs
 import datetime as datetime
+import os
+import sys
+import atexit
+import signal
+from interaction_writer import InteractionWriter
+import token_signing
 
 app = Flask(__name__)
 
+# Make sure tokens issued before the reverse index existed can be resolved
+logs.rebuild_token_index()
+
+# Hits are written in the background, so redirects never wait for the logs
+interactions = InteractionWriter(
+    resolve=logs.lookup_token,
+    write_batch=logs.add_interactions,
+    max_queue=int(os.getenv('INTERACTION_QUEUE_SIZE', '10000')),
+    batch_size=int(os.getenv('INTERACTION_BATCH_SIZE', '100')),
+    flush_interval=float(os.getenv('INTERACTION_FLUSH_SECONDS', '1')),
+    max_attempts=int(os.getenv('INTERACTION_MAX_ATTEMPTS', '3'))
+)
+# Write the queued hits before exiting
+atexit.register(interactions.stop)
+
 @app.route("/<token>")
 def track_and_redirect(token):
     # Get the client IP from X-Forwarded-For or fallback to remote_addr
@@ -11,9 +37,23 @@ def track_and_redirect(token):
     user_agent = request.headers.get('User-Agent')
     referrer = request.referrer
 
+    # Signed tokens are checked without any I/O; tokens bound to a conversation need no lookup,
+    # while unbound (decoy) and legacy UUID tokens are resolved through the token index
+    match = token_signing.verify(token)
+    if match is None and not token_signing.has_keys() and token_signing.looks_signed(token):
+        # The mail server signs tokens but this server has no key: resolved through the
+        # token index rather than lost, but the configuration has to be fixed
+        print(f"ERROR: received signed token {token} but TOKEN_SIGNING_KEYS is not set on the tracking server. "
+              "Set the same keys as the mail server.")
+    elif match is None and not token_signing.is_legacy(token):
+        print(f"Rejecting invalid token {token} from {visitor_ip}")
+        return redirect("https://google.com", code=302)
+    if match is not None and match[0] is None:
+        match = None
+
     timestamp = datetime.datetime.now().isoformat()
-    # Log the unique token and visitor information
-    logs.add_token_interaction(token, visitor_ip, user_agent, timestamp)
+    # Queue the unique token and visitor information; unknown tokens are discarded by the writer
+    interactions.submit(token, visitor_ip, user_agent, timestamp, match)
     print(f"Received a request from {visitor_ip} with user agent {user_agent} and referrer {referrer} for token {token}")
 
     # Redirect to the target URL
@@ -21,4 +61,6 @@ def track_and_redirect(token):
 
 
 if __name__ == "__main__":
+    # Exit cleanly on SIGTERM (systemd stop) so the queued hits are written
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
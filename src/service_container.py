@@ -0,0 +1,127 @@
+import importlib
+import threading
+import time
+from contextlib import contextmanager
+
+
+def build_gmail(module):
+    return module.GmailService()
+
+def build_openai(module):
+    return module.OpenAIClient()
+
+def build_nlp(module):
+    return module.PDFTriggerDetector()
+
+def build_pdf(module):
+    return module.start()
+
+# Component name -> (module imported on first use, function building the instance from it)
+COMPONENTS = {
+    "gmail": ("gmail_service", build_gmail),
+    "openai": ("openai_service", build_openai),
+    "nlp": ("nlp", build_nlp),
+    "pdf": ("pdf_renderer", build_pdf),
+}
+
+
+class ServiceContainer:
+    """
+    Shared, lazily built instances of the heavy services (Gmail, OpenAI, spaCy, PDF rendering).
+    A component's module is only imported, and its instance only built, the first time it
+    is needed, once per process. The import and build times of each component are recorded
+    for the startup report.
+    """
+
+    def __init__(self, components=COMPONENTS):
+        """
+        Initialize the container.
+        :param components: Component name -> (module name, build function).
+        """
+        self.components = components
+        self.instances = {}
+        self.timings = {}
+        self.locks = {name: threading.Lock() for name in components}
+        self.started = time.perf_counter()
+
+    def get(self, name):
+        """
+        Get a component, importing and building it on first use.
+        :param name: The component name.
+        :return: The shared instance.
+        """
+        instance = self.instances.get(name)
+        if instance is not None:
+            return instance
+        # One lock per component, so building spaCy does not hold up the Gmail client
+        with self.locks[name]:
+            if name not in self.instances:
+                module_name, build = self.components[name]
+                start = time.perf_counter()
+                module = importlib.import_module(module_name)
+                imported = time.perf_counter()
+                self.instances[name] = build(module)
+                built = time.perf_counter()
+                self.timings[name] = {"import": imported - start, "init": built - imported}
+                print(f"Service {name} ready in {built - start:.2f}s "
+                      f"(import {imported - start:.2f}s, init {built - imported:.2f}s).")
+            return self.instances[name]
+
+    def gmail(self):
+        return self.get("gmail")
+
+    def openai(self):
+        return self.get("openai")
+
+    def nlp(self):
+        return self.get("nlp")
+
+    def pdf(self):
+        return self.get("pdf")
+
+    @contextmanager
+    def timed(self, name):
+        """
+        Record the time spent in a block, typically module imports, in the startup report.
+        :param name: The name of the block in the report.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = {"import": time.perf_counter() - start, "init": 0.0}
+
+    def warm_up(self, *names, report=False):
+        """
+        Build components in a background thread, so that the first email needing them does not wait.
+        :param names: The component names.
+        :param report: Whether to print the startup report once they are built.
+        :return: The warm-up thread.
+        """
+        def build_all():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as error:
+                    print(f"An error occurred while warming up {name}: {error}")
+            if report:
+                self.startup_report()
+
+        thread = threading.Thread(target=build_all, name="service-warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def startup_report(self):
+        """
+        Print the import and init time of every component built so far.
+        """
+        print(f"Startup report, {time.perf_counter() - self.started:.2f}s since the container was created:")
+        for name, timing in list(self.timings.items()):
+            print(f"  {name:<8} import {timing['import']:.2f}s  init {timing['init']:.2f}s")
+        pending = [name for name in self.components if name not in self.timings]
+        if pending:
+            print(f"  Not loaded yet: {', '.join(pending)}")
+
+
+# The process-wide container
+services = ServiceContainer()
@@ -0,0 +1,145 @@
+import base64
+import hashlib
+import hmac
+import os
+import re
+import struct
+import time
+import uuid
+
+# Token layout, before base64url encoding:
+#   version (1 byte) | kind (1 byte) | key ID (1 byte) | issue time (4 bytes, Unix seconds)
+#   | nonce (4 bytes) | reference length (1 byte) | conversation reference | HMAC-SHA256 (16 bytes)
+# The high bit of the reference length marks a conversation ID stored as raw bytes from hex.
+VERSION = 1
+KINDS = {"signature": 0, "honeytoken": 1}
+KIND_NAMES = {code: kind for kind, code in KINDS.items()}
+HEADER = struct.Struct(">BBBIIB")
+MAC_SIZE = 16
+HEX_REFERENCE = 0x80
+
+# Tokens issued before signing existed
+LEGACY_TOKEN = re.compile(r'^[0-9a-f]{32}$')
+
+# Signed tokens older than this are rejected
+MAX_AGE = int(os.getenv('TOKEN_MAX_AGE_DAYS', '365')) * 24 * 3600
+# Tolerated clock difference between the mail and tracking servers
+CLOCK_SKEW = 300
+
+keys = None
+
+
+def load_keys():
+    """
+    Load the signing keys from TOKEN_SIGNING_KEYS, a comma-separated list of `id:secret`
+    pairs with IDs from 0 to 255. The first key signs new tokens; all of them are accepted,
+    so a new key is rolled out by putting it first and the old one is removed once its
+    tokens have expired. Keys are read on first use, so both the mail and the tracking
+    server load their .env file before issuing or verifying a token.
+    :return: A (signing key ID, {key ID: secret}) tuple, with a None key ID if no keys are configured.
+    """
+    global keys
+    if keys is None:
+        secrets = {}
+        active = None
+        for item in filter(None, (part.strip() for part in os.getenv('TOKEN_SIGNING_KEYS', '').split(','))):
+            key_id, _, secret = item.partition(':')
+            if not secret or not key_id.isdigit() or int(key_id) > 255:
+                raise ValueError("TOKEN_SIGNING_KEYS entries must look like <id 0-255>:<secret>.")
+            secrets[int(key_id)] = secret.encode()
+            if active is None:
+                active = int(key_id)
+        if active is None:
+            print("TOKEN_SIGNING_KEYS is not set: new tokens are unsigned and signed tokens cannot be verified.")
+        keys = (active, secrets)
+    return keys
+
+def encode_reference(conversation_id):
+    if conversation_id is None:
+        return 0, b""
+    if re.fullmatch(r'(?:[0-9a-f]{2})+', conversation_id):
+        raw = bytes.fromhex(conversation_id)
+        return HEX_REFERENCE | len(raw), raw
+    raw = conversation_id.encode()
+    if len(raw) >= HEX_REFERENCE:
+        raise ValueError(f"Conversation ID too long to sign: {conversation_id}")
+    return len(raw), raw
+
+def decode_reference(flags, raw):
+    if not raw:
+        return None
+    return raw.hex() if flags & HEX_REFERENCE else raw.decode()
+
+def sign(secret, payload):
+    return hmac.new(secret, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+def issue(kind, conversation_id=None):
+    """
+    Issue a token.
+    :param kind: "signature" or "honeytoken".
+    :param conversation_id: The conversation the token belongs to, or None for a token
+                            handed out before its conversation is known (decoy PDFs).
+    :return: The token, or a plain UUID if no signing key is configured.
+    """
+    active, secrets = load_keys()
+    if active is None:
+        return uuid.uuid4().hex
+    flags, reference = encode_reference(conversation_id)
+    payload = HEADER.pack(VERSION, KINDS[kind], active, int(time.time()),
+                          int.from_bytes(os.urandom(4), "big"), flags) + reference
+    token = payload + sign(secrets[active], payload)
+    return base64.urlsafe_b64encode(token).rstrip(b"=").decode()
+
+def verify(token, now=None):
+    """
+    Check a token without any I/O. The MAC is computed and compared in constant time,
+    also for unknown key IDs, so forged tokens cannot be told apart by timing.
+    :param token: The token from the URL.
+    :param now: The current Unix time, for tests.
+    :return: A (conversation_id, kind) tuple, with a None conversation ID for unbound tokens,
+             or None if the token is malformed, forged or expired.
+    """
+    _, secrets = load_keys()
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, TypeError):
+        return None
+    if len(data) < HEADER.size + MAC_SIZE:
+        return None
+
+    payload, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+    version, kind, key_id, issued_at, _, flags = HEADER.unpack_from(payload)
+    secret = secrets.get(key_id)
+    # Unknown keys are checked against a throwaway secret that can never match
+    valid = hmac.compare_digest(sign(secret or os.urandom(32), payload), mac)
+    if not valid or secret is None or version != VERSION or kind not in KIND_NAMES:
+        return None
+    if len(payload) != HEADER.size + (flags & ~HEX_REFERENCE):
+        return None
+
+    now = time.time() if now is None else now
+    if issued_at > now + CLOCK_SKEW or now - issued_at > MAX_AGE:
+        return None
+    return decode_reference(flags, payload[HEADER.size:]), KIND_NAMES[kind]
+
+def has_keys():
+    """Check if signing keys are configured."""
+    return load_keys()[0] is not None
+
+def looks_signed(token):
+    """
+    Check if a token has the shape of a signed token, without verifying it.
+    """
+    if is_legacy(token):
+        return False
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (ValueError, TypeError):
+        return False
+    return len(data) >= HEADER.size + MAC_SIZE
+
+def is_legacy(token):
+    """
+    Check if a token has the format of the unsigned tokens, which are resolved through the token index.
+    """
+    return LEGACY_TOKEN.match(token) is not None